@@ -1,22 +1,45 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import (Flask, render_template, request, redirect, url_for, session, flash, jsonify, Response, send_file, g,
+                   has_request_context)
 from flask_bcrypt import Bcrypt
+from argon2 import PasswordHasher, Type, extract_parameters
+from argon2.exceptions import InvalidHashError, VerificationError
+from flask_session import Session
+import redis
 import psycopg2
-from psycopg2.extras import RealDictCursor
+import psycopg2.errors
+from psycopg2.extras import RealDictCursor, NamedTupleCursor, execute_values
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from psycopg2.pool import ThreadedConnectionPool
 from dotenv import load_dotenv
 import os
+import re
 import hashlib
+import hmac
 from datetime import datetime, date, timedelta
-from functools import wraps
+from functools import wraps, lru_cache
+from itertools import zip_longest
+from contextlib import contextmanager
 import io
 import csv
 import subprocess
 import json
 import threading
+import queue
 import schedule
 import time
+import traceback
+import atexit
+import tempfile
+import secrets
 from pathlib import Path
+from collections import deque, namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, PatternFill, Alignment
+from openpyxl.utils import get_column_letter
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 # Load environment variables
@@ -28,6 +51,166 @@ app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=1)
 app.secret_key = os.getenv('SECRET_KEY', 'dev-secret-key-change-in-production')
 bcrypt = Bcrypt(app)
 
+# Keep sessions server-side in Redis when REDIS_URL is set (the cookie then only
+# holds an opaque session id); otherwise use Flask's signed-cookie sessions
+REDIS_URL = os.getenv('REDIS_URL')
+if REDIS_URL:
+    app.config.update(
+        SESSION_TYPE='redis',
+        SESSION_REDIS=redis.Redis.from_url(REDIS_URL),
+        SESSION_PERMANENT=False,
+    )
+    Session(app)
+
+# Password hashing configuration
+# New hashes are Argon2id; existing bcrypt hashes still verify and are
+# rehashed to Argon2id on the user's next successful login.
+ARGON2_MEMORY_COST = int(os.getenv('ARGON2_MEMORY_COST', '19456'))  # KiB
+ARGON2_PARALLELISM = int(os.getenv('ARGON2_PARALLELISM', '1'))
+ARGON2_TARGET_MS = int(os.getenv('ARGON2_TARGET_MS', '100'))
+ARGON2_MIN_TIME_COST = 2
+ARGON2_MAX_TIME_COST = 10
+
+
+def calibrate_argon2_time_cost(target_ms=ARGON2_TARGET_MS):
+    """Smallest Argon2 time cost whose hash takes at least target_ms on this machine"""
+    for time_cost in range(ARGON2_MIN_TIME_COST, ARGON2_MAX_TIME_COST):
+        hasher = PasswordHasher(time_cost=time_cost, memory_cost=ARGON2_MEMORY_COST,
+                                parallelism=ARGON2_PARALLELISM)
+        start = time.perf_counter()
+        hasher.hash('calibration')
+        if (time.perf_counter() - start) * 1000 >= target_ms:
+            return time_cost
+    return ARGON2_MAX_TIME_COST
+
+
+# An explicit ARGON2_TIME_COST pins the cost; otherwise it is measured at startup
+ARGON2_TIME_COST = int(os.getenv('ARGON2_TIME_COST') or 0) or calibrate_argon2_time_cost()
+password_hasher = PasswordHasher(time_cost=ARGON2_TIME_COST, memory_cost=ARGON2_MEMORY_COST,
+                                 parallelism=ARGON2_PARALLELISM)
+
+# Password used by the admin "reset password" action
+DEFAULT_PASSWORD = 'password123'
+DEFAULT_PASSWORD_POOL_SIZE = 8
+
+
+def _new_password_hash_executor():
+    return ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix='password-hash')
+
+
+# Hashing runs in a bounded pool so a slow hash never pins a whole worker
+password_hash_executor = _new_password_hash_executor()
+
+# Precomputed (individually salted) hashes of DEFAULT_PASSWORD
+default_password_hashes = deque()
+default_password_refill_lock = threading.Lock()
+
+
+# Recently verified logins: HMAC(username, password) -> (password_hash, expiry).
+# The key is random per process, so no password can be recovered from the memo.
+LOGIN_CACHE_TTL = 60  # seconds
+LOGIN_CACHE_SIZE = 10000
+login_cache_key = secrets.token_bytes(32)
+verified_logins = OrderedDict()
+verified_logins_lock = threading.Lock()
+
+
+def _reset_password_hashing_after_fork():
+    """Executor threads and locks do not survive fork(), so every worker gets its own"""
+    global password_hash_executor, default_password_refill_lock, verified_logins_lock
+    password_hash_executor = _new_password_hash_executor()
+    default_password_refill_lock = threading.Lock()
+    verified_logins_lock = threading.Lock()
+    # Don't hand out the same salted hashes in every worker
+    default_password_hashes.clear()
+
+
+os.register_at_fork(after_in_child=_reset_password_hashing_after_fork)
+
+
+def hash_password(password):
+    """Hash a password with Argon2id in the hashing pool"""
+    return password_hash_executor.submit(password_hasher.hash, password).result()
+
+
+def _verify_password(password_hash, password):
+    """Check a password against an Argon2id or legacy bcrypt hash"""
+    if not password_hash.startswith('$argon2'):
+        return bcrypt.check_password_hash(password_hash, password)
+    try:
+        return password_hasher.verify(password_hash, password)
+    except (VerificationError, InvalidHashError):
+        return False
+
+
+def check_password(password_hash, password):
+    """Verify a password against a stored hash in the hashing pool"""
+    future = password_hash_executor.submit(_verify_password, password_hash, password)
+    return future.result()
+
+
+def password_needs_rehash(password_hash):
+    """True for legacy bcrypt hashes and Argon2 hashes weaker than the current parameters"""
+    if not password_hash.startswith('$argon2'):
+        return True
+    try:
+        params = extract_parameters(password_hash)
+    except InvalidHashError:
+        return True
+    # Only upgrade, so a calibration that lands one step lower elsewhere doesn't churn hashes
+    return (params.type is not Type.ID or params.time_cost < ARGON2_TIME_COST
+            or params.memory_cost < ARGON2_MEMORY_COST)
+
+
+def verify_login(username, password, password_hash):
+    """
+    check_password() that remembers successful checks for LOGIN_CACHE_TTL seconds
+
+    A memo entry only counts while the user's stored hash is unchanged, so a
+    password change or reset takes effect immediately. Failures are never cached.
+    """
+    digest = hmac.new(login_cache_key, f'{username}\0{password}'.encode('utf-8'), 'sha256').digest()
+    now = time.monotonic()
+    with verified_logins_lock:
+        entry = verified_logins.get(digest)
+        if entry and entry[0] == password_hash and entry[1] > now:
+            return True
+
+    if not check_password(password_hash, password):
+        return False
+
+    with verified_logins_lock:
+        verified_logins[digest] = (password_hash, now + LOGIN_CACHE_TTL)
+        verified_logins.move_to_end(digest)
+        while len(verified_logins) > LOGIN_CACHE_SIZE:
+            verified_logins.popitem(last=False)
+    return True
+
+
+def refill_default_password_hashes():
+    """Top up the pool of precomputed default-password hashes"""
+    if not default_password_refill_lock.acquire(blocking=False):
+        return
+    try:
+        while len(default_password_hashes) < DEFAULT_PASSWORD_POOL_SIZE:
+            default_password_hashes.append(password_hasher.hash(DEFAULT_PASSWORD))
+    finally:
+        default_password_refill_lock.release()
+
+
+def default_password_hash():
+    """Take a precomputed default-password hash, hashing synchronously only if the pool is empty"""
+    try:
+        password_hash = default_password_hashes.popleft()
+    except IndexError:
+        password_hash = hash_password(DEFAULT_PASSWORD)
+    password_hash_executor.submit(refill_default_password_hashes)
+    return password_hash
+
+
+password_hash_executor.submit(refill_default_password_hashes)
+
+
 # Security headers
 @app.after_request
 def security_headers(response):
@@ -35,6 +218,9 @@ def security_headers(response):
     response.headers['X-Frame-Options'] = 'DENY'
     response.headers['X-XSS-Protection'] = '1; mode=block'
     response.headers['Strict-Transport-Security'] = 'max-age=31536000; includeSubDomains'
+    # Pages for a logged-in user must never be stored by a shared cache/proxy
+    if g.get('user') is not None:
+        response.cache_control.private = True
     return response
 
 # Database configuration
@@ -46,9 +232,26 @@ DB_CONFIG = {
     'port': os.getenv('DB_PORT', '5432')
 }
 
+# Bump whenever init_database() gains new tables, columns or indexes
+SCHEMA_VERSION = 2
+# Advisory lock key serializing schema creation between processes
+INIT_DATABASE_LOCK_ID = 42
+
+# Connection pool sizing (per worker process)
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '2'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '20'))
+
 # Configuration for starting Patient ID
 STARTING_PATIENT_ID = int(os.getenv('STARTING_PATIENT_ID', '1500'))
 
+# Save new patients without waiting for the WAL flush (synchronous_commit = off).
+# Faster on slow disks, but a server crash can lose saves confirmed in the last
+# moment before it - only enable where data entry can be redone.
+ASYNC_PATIENT_COMMIT = os.getenv('ASYNC_PATIENT_COMMIT', 'False').lower() in ('1', 'true')
+
+# Above this many rows the dashboard shows the planner's row estimate instead of COUNT(*)
+DASHBOARD_EXACT_COUNT_LIMIT = 100000
+
 # Backup configuration
 BACKUP_CONFIG_FILE = os.getenv('BACKUP_CONFIG_FILE', 'backup_config.json')
 DEFAULT_BACKUP_DIR = os.getenv('BACKUP_DIRECTORY', '/backups')
@@ -99,236 +302,562 @@ def create_database_if_not_exists():
         return False
 
 
+class PooledConnection(psycopg2.extensions.connection):
+    """Connection that remembers whether it is currently checked out of the pool"""
+    checked_out = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Names of the PREPARED_STATEMENTS already prepared in this session
+        self.prepared_statements = set()
+        self._shared_cursor = None
+
+    def shared_cursor(self):
+        """Plain cursor kept for the connection's lifetime, reused by the single-lookup hot paths"""
+        if self._shared_cursor is None or self._shared_cursor.closed:
+            self._shared_cursor = self.cursor()
+        return self._shared_cursor
+
+
+db_pool = None
+db_pool_lock = threading.Lock()
+# Pools inherited across fork() are kept referenced so their sockets are never
+# closed from the child - they still belong to the parent process.
+inherited_db_pools = []
+
+
+def _reset_db_pool_after_fork():
+    """Give a forked worker its own pool; the parent's connections can't be shared"""
+    global db_pool, db_pool_lock
+    if db_pool is not None:
+        inherited_db_pools.append(db_pool)
+    db_pool = None
+    db_pool_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_db_pool_after_fork)
+
+
+def get_db_pool():
+    """Return this process's connection pool, creating it on first use"""
+    global db_pool
+    if db_pool is None:
+        with db_pool_lock:
+            if db_pool is None:
+                db_pool = ThreadedConnectionPool(
+                    DB_POOL_MIN, DB_POOL_MAX,
+                    connection_factory=PooledConnection,
+                    **DB_CONFIG
+                )
+    return db_pool
+
+
+def close_db_pool():
+    """Close every pooled connection (used before gunicorn forks its workers)"""
+    global db_pool
+    with db_pool_lock:
+        if db_pool is not None:
+            db_pool.closeall()
+            db_pool = None
+
+
+# ocular_conditions columns with the patient-form field and default for each, in
+# table order - the insert/update statements and their parameters are built from it
+OCULAR_CONDITION_FIELDS = (
+    ('lens_status', 'lens_status', 'ND'),
+    ('locs_iii_no', 'locs_no', 'ND'),
+    ('locs_iii_nc', 'locs_nc', 'ND'),
+    ('locs_iii_c', 'locs_c', 'ND'),
+    ('locs_iii_p', 'locs_p', 'ND'),
+    ('iol_type', 'iol_type', 'ND'),
+    ('etiology_aphakia', 'aphakia_etiology', 'ND'),
+    ('glaucoma', 'glaucoma', 'ND'),
+    ('oht_or_pac', 'oht_or_pac', 'ND'),
+    ('etiology_glaucoma', 'glaucoma_etiology', 'ND'),
+    ('steroid_responder', 'steroid_responder', 'ND'),
+    ('pxs', 'pxs', '0'),
+    ('pds', 'pds', '0'),
+    ('diabetic_retinopathy', 'diabetic_retinopathy', '0'),
+    ('stage_diabetic_retinopathy', 'dr_stage', 'ND'),
+    ('stage_npdr', 'npdr_stage', 'ND'),
+    ('stage_pdr', 'pdr_stage', 'ND'),
+    ('macular_edema', 'macular_edema', '0'),
+    ('etiology_macular_edema', 'me_etiology', 'ND'),
+    ('macular_degeneration_dystrophy', 'macular_degeneration', '0'),
+    ('etiology_macular_deg_dyst', 'md_etiology', 'ND'),
+    ('stage_amd', 'amd_stage', 'ND'),
+    ('exudation_amd', 'amd_exudation', 'ND'),
+    ('stage_other_macular_deg', 'other_md_stage', 'ND'),
+    ('exudation_other_macular_deg', 'other_md_exudation', 'ND'),
+    ('macular_hole_vmt', 'mh_vmt', '0'),
+    ('etiology_mh_vmt', 'mh_vmt_etiology', 'ND'),
+    ('cause_secondary_mh_vmt', 'secondary_mh_vmt_cause', 'ND'),
+    ('treatment_status_mh_vmt', 'mh_vmt_treatment_status', 'ND'),
+    ('epiretinal_membrane', 'epiretinal_membrane', '0'),
+    ('etiology_erm', 'erm_etiology', 'ND'),
+    ('cause_secondary_erm', 'secondary_erm_cause', 'ND'),
+    ('treatment_status_erm', 'erm_treatment_status', 'ND'),
+    ('retinal_detachment', 'retinal_detachment', '0'),
+    ('etiology_rd', 'rd_etiology', 'ND'),
+    ('treatment_status_rd', 'rd_treatment_status', 'ND'),
+    ('pvr', 'pvr', 'ND'),
+    ('vitreous_haemorrhage_opacification', 'vitreous_opacification', '0'),
+    ('etiology_vitreous_haemorrhage', 'vh_etiology', 'ND'),
+)
+OCULAR_CONDITION_COLUMNS = ', '.join(column for column, _, _ in OCULAR_CONDITION_FIELDS)
+# form field name -> default, in column order
+OCULAR_CONDITION_DEFAULTS = {key: default for _, key, default in OCULAR_CONDITION_FIELDS}
+
+
+# Smallest available ID starting from STARTING_PATIENT_ID (finds gaps in the sequence).
+# Kept as a bare expression so other queries can embed it as a scalar subquery;
+# it takes (STARTING_PATIENT_ID, STARTING_PATIENT_ID) as parameters.
+NEXT_PATIENT_ID_SQL = """
+    COALESCE(
+        (SELECT MIN(t1.patient_id + 1)
+         FROM patients_sensitive t1
+         WHERE NOT EXISTS (
+             SELECT 1 FROM patients_sensitive t2
+             WHERE t2.patient_id = t1.patient_id + 1
+         )
+         AND t1.patient_id >= %s),
+        %s
+    )
+"""
+
+
+# Hot lookups prepared once per pooled session, so repeat calls skip parsing and planning.
+# name -> (parameter types, statement)
+PREPARED_STATEMENTS = {
+    'user_by_username': (
+        'text',
+        'SELECT user_id, username, password_hash, role FROM users WHERE username = $1'
+    ),
+    'patient_id_exists': (
+        'integer',
+        'SELECT EXISTS (SELECT 1 FROM patients_sensitive WHERE patient_id = $1)'
+    ),
+    # New patient: patients_sensitive + patients_statistical + ocular_conditions
+    'insert_patient': (
+        ', '.join(['integer', 'text', 'text', 'date', 'date', 'integer', 'text', 'text']
+                  + ['text'] * len(OCULAR_CONDITION_FIELDS)),
+        '''
+        WITH ins_sensitive AS (
+            -- A NULL patient ID takes the next free one; a taken ID inserts
+            -- nothing here, so nothing below either and no row comes back
+            INSERT INTO patients_sensitive (patient_id, patient_name, mbo, date_of_birth, date_of_sample_collection)
+            VALUES (COALESCE($1, {next_patient_id}), $2, $3, $4, $5)
+            ON CONFLICT (patient_id) DO NOTHING
+            RETURNING patient_id
+        ), ins_statistical AS (
+            -- person_hash is the SHA-256 of the MBO, hashed by the server (same digest as generate_person_hash)
+            INSERT INTO patients_statistical (patient_id, person_hash, age, sex, eye)
+            SELECT patient_id, encode(sha256(convert_to($3, 'UTF8')), 'hex'), $6, $7, $8 FROM ins_sensitive
+        )
+        INSERT INTO ocular_conditions (patient_id, {columns})
+        SELECT patient_id, {placeholders} FROM ins_sensitive
+        RETURNING patient_id
+        '''.format(next_patient_id=NEXT_PATIENT_ID_SQL % (STARTING_PATIENT_ID, STARTING_PATIENT_ID),
+                   columns=OCULAR_CONDITION_COLUMNS,
+                   placeholders=', '.join(f'${n}' for n in range(9, 9 + len(OCULAR_CONDITION_FIELDS))))
+    ),
+    # Edit patient: the same three tables, updated in place
+    'update_patient': (
+        ', '.join(['text', 'text', 'date', 'date', 'integer', 'text', 'integer', 'text', 'text']
+                  + ['text'] * len(OCULAR_CONDITION_FIELDS)),
+        '''
+        WITH upd_sensitive AS (
+            UPDATE patients_sensitive
+            SET patient_name = $1, mbo = $2, date_of_birth = $3,
+                date_of_sample_collection = $4, updated_at = CURRENT_TIMESTAMP
+            WHERE patient_id = $5
+        ), upd_statistical AS (
+            UPDATE patients_statistical
+            SET person_hash = $6, age = $7, sex = $8, eye = $9
+            WHERE patient_id = $5
+        )
+        UPDATE ocular_conditions
+        SET ({columns}, updated_at) = ({placeholders}, CURRENT_TIMESTAMP)
+        WHERE patient_id = $5
+        '''.format(columns=OCULAR_CONDITION_COLUMNS,
+                   placeholders=', '.join(f'${n}' for n in range(10, 10 + len(OCULAR_CONDITION_FIELDS))))
+    ),
+}
+
+
+def execute_prepared(cur, name, params):
+    """Run one of PREPARED_STATEMENTS, preparing it on this connection first if needed"""
+    prepared = cur.connection.prepared_statements
+    if name not in prepared:
+        # Prepared statements belong to the session, not the transaction,
+        # so they survive the rollback done when the connection is released
+        param_types, query = PREPARED_STATEMENTS[name]
+        cur.execute(f'PREPARE {name} ({param_types}) AS {query}')
+        prepared.add(name)
+    placeholders = ', '.join(['%s'] * len(params))
+    cur.execute(f'EXECUTE {name} ({placeholders})', params)
+
+
 def get_db_connection():
-    """Create and return a database connection"""
+    """Check out a database connection from the pool"""
     try:
-        conn = psycopg2.connect(**DB_CONFIG)
+        conn = get_db_pool().getconn()
+        conn.checked_out = True
+        if has_request_context():
+            # Tracked so teardown can return it if the route never does
+            g.setdefault('db_connections', []).append(conn)
         return conn
     except Exception as e:
         print(f"Database connection error: {e}")
         return None
 
 
-def init_database():
-    """Initialize database with all required tables and ICD-10 codes from Excel if available"""
-    conn = get_db_connection()
-    if not conn:
-        print("Failed to connect to database")
-        return False
-
+def release_db_connection(conn):
+    """Return a connection to the pool; safe to call more than once"""
+    if conn is None or not conn.checked_out:
+        return
+    conn.checked_out = False
+    if has_request_context():
+        held = g.get('db_connections')
+        if held and conn in held:
+            held.remove(conn)
     try:
-        cur = conn.cursor()
+        if not conn.closed and conn.autocommit:
+            conn.autocommit = False
+        get_db_pool().putconn(conn)
+    except Exception as e:
+        print(f"Error returning connection to pool: {e}")
+        conn.close()
 
-        print("Configuring tables...")
 
-        # Create users table
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id SERIAL PRIMARY KEY,
-                username VARCHAR(50) UNIQUE NOT NULL,
-                password_hash VARCHAR(255) NOT NULL,
-                email VARCHAR(100),
-                role VARCHAR(20) NOT NULL CHECK (role IN ('Administrator', 'Staff', 'Patient')),
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_login TIMESTAMP
-            )
-        ''')
+@contextmanager
+def db_connection():
+    """
+    Pooled connection for a with-block, released when the block exits
 
-        # Create patients_sensitive table (PII data)
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS patients_sensitive (
-                patient_id INTEGER PRIMARY KEY CHECK (patient_id >= 1 AND patient_id <= 99999),
-                patient_name VARCHAR(255) NOT NULL,
-                mbo VARCHAR(9) NOT NULL,
-                date_of_birth DATE,
-                date_of_sample_collection DATE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+    Yields None if no connection could be made, like get_db_connection().
+    """
+    conn = get_db_connection()
+    try:
+        yield conn
+    finally:
+        release_db_connection(conn)
 
-        # Create patients_statistical table (anonymized data)
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS patients_statistical (
-                patient_id INTEGER PRIMARY KEY REFERENCES patients_sensitive(patient_id) ON DELETE CASCADE,
-                person_hash VARCHAR(64) NOT NULL,
-                age INTEGER,
-                sex VARCHAR(1) CHECK (sex IN ('M', 'F')),
-                eye VARCHAR(3) CHECK (eye IN ('L', 'R', 'ND')),
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
 
-        # Create ocular_conditions table (main conditions - one row per patient)
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS ocular_conditions (
-                patient_id INTEGER PRIMARY KEY REFERENCES patients_sensitive(patient_id) ON DELETE CASCADE,
-                lens_status VARCHAR(20) CHECK (lens_status IN ('Phakic', 'Pseudophakic', 'Aphakic', 'ND')),
-                locs_iii_no VARCHAR(10),
-                locs_iii_nc VARCHAR(10),
-                locs_iii_c VARCHAR(10),
-                locs_iii_p VARCHAR(10),
-                iol_type VARCHAR(50),
-                etiology_aphakia VARCHAR(50),
-                glaucoma VARCHAR(10),
-                oht_or_pac VARCHAR(10),
-                etiology_glaucoma VARCHAR(50),
-                steroid_responder VARCHAR(10),
-                pxs VARCHAR(10),
-                pds VARCHAR(10),
-                diabetic_retinopathy VARCHAR(10),
-                stage_diabetic_retinopathy VARCHAR(50),
-                stage_npdr VARCHAR(50),
-                stage_pdr VARCHAR(50),
-                macular_edema VARCHAR(10),
-                etiology_macular_edema VARCHAR(50),
-                macular_degeneration_dystrophy VARCHAR(10),
-                etiology_macular_deg_dyst VARCHAR(50),
-                stage_amd VARCHAR(50),
-                exudation_amd VARCHAR(10),
-                stage_other_macular_deg VARCHAR(50),
-                exudation_other_macular_deg VARCHAR(10),
-                macular_hole_vmt VARCHAR(10),
-                etiology_mh_vmt VARCHAR(50),
-                cause_secondary_mh_vmt TEXT,
-                treatment_status_mh_vmt VARCHAR(50),
-                epiretinal_membrane VARCHAR(10),
-                etiology_erm VARCHAR(50),
-                cause_secondary_erm TEXT,
-                treatment_status_erm VARCHAR(50),
-                retinal_detachment VARCHAR(50),
-                etiology_rd VARCHAR(100),
-                treatment_status_rd VARCHAR(100),
-                pvr VARCHAR(10),
-                vitreous_haemorrhage_opacification VARCHAR(50),
-                etiology_vitreous_haemorrhage VARCHAR(100),
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+@contextmanager
+def db_cursor(cursor_factory=RealDictCursor):
+    """
+    Cursor on a pooled connection for a read-only with-block
 
-        # Create other_ocular_conditions table (one-to-many)
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS other_ocular_conditions (
-                id SERIAL PRIMARY KEY,
-                patient_id INTEGER REFERENCES patients_sensitive(patient_id) ON DELETE CASCADE,
-                icd10_code VARCHAR(20) NOT NULL,
-                eye VARCHAR(10) CHECK (eye IN ('R', 'L', 'R+L', 'ND')),
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+    Runs in autocommit, so the reads don't pay for BEGIN/ROLLBACK round trips;
+    the connection goes back to the pool when the block exits. Yields None if
+    no connection could be made.
+    """
+    with db_connection() as conn:
+        if not conn:
+            yield None
+            return
+        conn.autocommit = True
+        with conn.cursor(cursor_factory=cursor_factory) as cur:
+            yield cur
+
+
+@app.teardown_appcontext
+def release_request_connections(exception):
+    """Return any connection a request checked out but never released (e.g. after an error)"""
+    for conn in g.pop('db_connections', ()):
+        release_db_connection(conn)
+
+
+# Close this process's pooled connections cleanly on shutdown
+atexit.register(close_db_pool)
+
+
+# Schema DDL, sent to the server in one round-trip by init_database()
+INIT_DDL = """
+    -- Create users table
+    CREATE TABLE IF NOT EXISTS users (
+        user_id SERIAL PRIMARY KEY,
+        username VARCHAR(50) UNIQUE NOT NULL,
+        password_hash VARCHAR(255) NOT NULL,
+        email VARCHAR(100),
+        role VARCHAR(20) NOT NULL CHECK (role IN ('Administrator', 'Staff', 'Patient')),
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        last_login TIMESTAMP
+    );
+
+    -- Create patients_sensitive table (PII data)
+    CREATE TABLE IF NOT EXISTS patients_sensitive (
+        patient_id INTEGER PRIMARY KEY CHECK (patient_id >= 1 AND patient_id <= 99999),
+        patient_name VARCHAR(255) NOT NULL,
+        mbo VARCHAR(9) NOT NULL,
+        date_of_birth DATE,
+        date_of_sample_collection DATE,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+
+    -- Create patients_statistical table (anonymized data)
+    CREATE TABLE IF NOT EXISTS patients_statistical (
+        patient_id INTEGER PRIMARY KEY REFERENCES patients_sensitive(patient_id) ON DELETE CASCADE,
+        person_hash VARCHAR(64) NOT NULL,
+        age INTEGER,
+        sex VARCHAR(1) CHECK (sex IN ('M', 'F')),
+        eye VARCHAR(3) CHECK (eye IN ('L', 'R', 'ND')),
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+
+    -- Create ocular_conditions table (main conditions - one row per patient)
+    CREATE TABLE IF NOT EXISTS ocular_conditions (
+        patient_id INTEGER PRIMARY KEY REFERENCES patients_sensitive(patient_id) ON DELETE CASCADE,
+        lens_status VARCHAR(20) CHECK (lens_status IN ('Phakic', 'Pseudophakic', 'Aphakic', 'ND')),
+        locs_iii_no VARCHAR(10),
+        locs_iii_nc VARCHAR(10),
+        locs_iii_c VARCHAR(10),
+        locs_iii_p VARCHAR(10),
+        iol_type VARCHAR(50),
+        etiology_aphakia VARCHAR(50),
+        glaucoma VARCHAR(10),
+        oht_or_pac VARCHAR(10),
+        etiology_glaucoma VARCHAR(50),
+        steroid_responder VARCHAR(10),
+        pxs VARCHAR(10),
+        pds VARCHAR(10),
+        diabetic_retinopathy VARCHAR(10),
+        stage_diabetic_retinopathy VARCHAR(50),
+        stage_npdr VARCHAR(50),
+        stage_pdr VARCHAR(50),
+        macular_edema VARCHAR(10),
+        etiology_macular_edema VARCHAR(50),
+        macular_degeneration_dystrophy VARCHAR(10),
+        etiology_macular_deg_dyst VARCHAR(50),
+        stage_amd VARCHAR(50),
+        exudation_amd VARCHAR(10),
+        stage_other_macular_deg VARCHAR(50),
+        exudation_other_macular_deg VARCHAR(10),
+        macular_hole_vmt VARCHAR(10),
+        etiology_mh_vmt VARCHAR(50),
+        cause_secondary_mh_vmt TEXT,
+        treatment_status_mh_vmt VARCHAR(50),
+        epiretinal_membrane VARCHAR(10),
+        etiology_erm VARCHAR(50),
+        cause_secondary_erm TEXT,
+        treatment_status_erm VARCHAR(50),
+        retinal_detachment VARCHAR(50),
+        etiology_rd VARCHAR(100),
+        treatment_status_rd VARCHAR(100),
+        pvr VARCHAR(10),
+        vitreous_haemorrhage_opacification VARCHAR(50),
+        etiology_vitreous_haemorrhage VARCHAR(100),
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+
+    -- Create other_ocular_conditions table (one-to-many)
+    CREATE TABLE IF NOT EXISTS other_ocular_conditions (
+        id SERIAL PRIMARY KEY,
+        patient_id INTEGER REFERENCES patients_sensitive(patient_id) ON DELETE CASCADE,
+        icd10_code VARCHAR(20) NOT NULL,
+        eye VARCHAR(10) CHECK (eye IN ('R', 'L', 'R+L', 'ND')),
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+
+    -- Create previous_ocular_surgeries table (one-to-many)
+    CREATE TABLE IF NOT EXISTS previous_ocular_surgeries (
+        id SERIAL PRIMARY KEY,
+        patient_id INTEGER REFERENCES patients_sensitive(patient_id) ON DELETE CASCADE,
+        surgery_code VARCHAR(100) NOT NULL,
+        eye VARCHAR(10) CHECK (eye IN ('R', 'L', 'R+L', 'ND')),
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+
+    -- Create systemic_conditions table (one-to-many)
+    CREATE TABLE IF NOT EXISTS systemic_conditions (
+        id SERIAL PRIMARY KEY,
+        patient_id INTEGER REFERENCES patients_sensitive(patient_id) ON DELETE CASCADE,
+        icd10_code VARCHAR(20) NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+
+    -- Create ocular_medications table (one-to-many)
+    CREATE TABLE IF NOT EXISTS ocular_medications (
+        id SERIAL PRIMARY KEY,
+        patient_id INTEGER REFERENCES patients_sensitive(patient_id) ON DELETE CASCADE,
+        trade_name VARCHAR(255) NOT NULL,
+        generic_name VARCHAR(255) NOT NULL,
+        eye VARCHAR(10) CHECK (eye IN ('R', 'L', 'R+L', 'ND')),
+        last_application_days INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+
+    -- Create systemic_medications table (one-to-many)
+    CREATE TABLE IF NOT EXISTS systemic_medications (
+        id SERIAL PRIMARY KEY,
+        patient_id INTEGER REFERENCES patients_sensitive(patient_id) ON DELETE CASCADE,
+        trade_name VARCHAR(255) NOT NULL,
+        generic_name VARCHAR(255) NOT NULL,
+        last_application_days INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+
+    -- Create reference data tables
+    CREATE TABLE IF NOT EXISTS icd10_ocular_conditions (
+        id SERIAL PRIMARY KEY,
+        code VARCHAR(20) UNIQUE NOT NULL,
+        description TEXT NOT NULL,
+        category VARCHAR(100),
+        active BOOLEAN DEFAULT TRUE,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+
+    CREATE TABLE IF NOT EXISTS icd10_systemic_conditions (
+        id SERIAL PRIMARY KEY,
+        code VARCHAR(20) UNIQUE NOT NULL,
+        description TEXT NOT NULL,
+        category VARCHAR(100),
+        active BOOLEAN DEFAULT TRUE,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+
+    CREATE TABLE IF NOT EXISTS medications (
+        id SERIAL PRIMARY KEY,
+        trade_name VARCHAR(255) NOT NULL,
+        generic_name VARCHAR(255) NOT NULL,
+        medication_type VARCHAR(20) CHECK (medication_type IN ('Ocular', 'Systemic', 'Both')),
+        active BOOLEAN DEFAULT TRUE,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+
+    CREATE TABLE IF NOT EXISTS surgeries (
+        id SERIAL PRIMARY KEY,
+        code VARCHAR(100) UNIQUE NOT NULL,
+        description TEXT NOT NULL,
+        category VARCHAR(100),
+        active BOOLEAN DEFAULT TRUE,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+
+    -- PostgreSQL doesn't index foreign keys on its own - the per-patient child tables
+    -- are joined/EXISTS-probed on patient_id by the filters, exports and cascading deletes
+    CREATE INDEX IF NOT EXISTS idx_other_ocular_conditions_patient_id ON other_ocular_conditions(patient_id);
+    CREATE INDEX IF NOT EXISTS idx_previous_ocular_surgeries_patient_id ON previous_ocular_surgeries(patient_id);
+    CREATE INDEX IF NOT EXISTS idx_systemic_conditions_patient_id ON systemic_conditions(patient_id);
+    CREATE INDEX IF NOT EXISTS idx_ocular_medications_patient_id ON ocular_medications(patient_id);
+    CREATE INDEX IF NOT EXISTS idx_systemic_medications_patient_id ON systemic_medications(patient_id);
+
+    -- Bulk medication import matches existing rows by trade name
+    CREATE INDEX IF NOT EXISTS idx_medications_trade_name ON medications(trade_name);
+
+    -- Record the schema version so later starts can skip the DDL above
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+"""
+
+# Trigram indexes for validate_data's substring searches (LIKE '%...%' can't use a
+# btree). pg_trgm comes with PostgreSQL's contrib modules, which not every install
+# has, so init_database() runs this on its own and carries on without it.
+SEARCH_INDEX_DDL = """
+    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+    CREATE INDEX IF NOT EXISTS idx_patients_sensitive_id_trgm
+        ON patients_sensitive USING gin ((patient_id::text) gin_trgm_ops);
+    CREATE INDEX IF NOT EXISTS idx_patients_sensitive_name_trgm
+        ON patients_sensitive USING gin (lower(patient_name) gin_trgm_ops);
+    CREATE INDEX IF NOT EXISTS idx_patients_sensitive_mbo_trgm
+        ON patients_sensitive USING gin (mbo gin_trgm_ops);
+"""
+
+
+# Shared by the default admin seed and the user-management form
+INSERT_USER_SQL = '''
+    INSERT INTO users (username, password_hash, email, role)
+    VALUES (%s, %s, %s, %s)
+'''
+
+
+def schema_is_current(conn, cur):
+    """True if the schema was already created by this version of the code"""
+    try:
+        cur.execute('SELECT 1 FROM schema_version WHERE version = %s', (SCHEMA_VERSION,))
+        return cur.fetchone() is not None
+    except psycopg2.errors.UndefinedTable:
+        conn.rollback()
+        return False
 
-        # Create previous_ocular_surgeries table (one-to-many)
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS previous_ocular_surgeries (
-                id SERIAL PRIMARY KEY,
-                patient_id INTEGER REFERENCES patients_sensitive(patient_id) ON DELETE CASCADE,
-                surgery_code VARCHAR(100) NOT NULL,
-                eye VARCHAR(10) CHECK (eye IN ('R', 'L', 'R+L', 'ND')),
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
 
-        # Create systemic_conditions table (one-to-many)
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS systemic_conditions (
-                id SERIAL PRIMARY KEY,
-                patient_id INTEGER REFERENCES patients_sensitive(patient_id) ON DELETE CASCADE,
-                icd10_code VARCHAR(20) NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+def init_database():
+    """Initialize database with all required tables and ICD-10 codes from Excel if available"""
+    conn = get_db_connection()
+    if not conn:
+        print("Failed to connect to database")
+        return False
 
-        # Create ocular_medications table (one-to-many)
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS ocular_medications (
-                id SERIAL PRIMARY KEY,
-                patient_id INTEGER REFERENCES patients_sensitive(patient_id) ON DELETE CASCADE,
-                trade_name VARCHAR(255) NOT NULL,
-                generic_name VARCHAR(255) NOT NULL,
-                eye VARCHAR(10) CHECK (eye IN ('R', 'L', 'R+L', 'ND')),
-                last_application_days INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+    try:
+        cur = conn.cursor()
 
-        # Create systemic_medications table (one-to-many)
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS systemic_medications (
-                id SERIAL PRIMARY KEY,
-                patient_id INTEGER REFERENCES patients_sensitive(patient_id) ON DELETE CASCADE,
-                trade_name VARCHAR(255) NOT NULL,
-                generic_name VARCHAR(255) NOT NULL,
-                last_application_days INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+        # Warm start: one SELECT, no DDL and no reference data checks (the
+        # startup sequence checks those once on its own)
+        if schema_is_current(conn, cur):
+            print(f"✓ Tables already at schema version {SCHEMA_VERSION}")
+            cur.close()
+            release_db_connection(conn)
+            return True
 
-        # Create reference data tables
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS icd10_ocular_conditions (
-                id SERIAL PRIMARY KEY,
-                code VARCHAR(20) UNIQUE NOT NULL,
-                description TEXT NOT NULL,
-                category VARCHAR(100),
-                active BOOLEAN DEFAULT TRUE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+        # Processes starting together on a new database (several containers, or
+        # gunicorn without preload_app) take turns from here; the later ones find
+        # the schema and reference data already in place
+        cur.execute('SELECT pg_advisory_lock(%s)', (INIT_DATABASE_LOCK_ID,))
+        try:
+            if schema_is_current(conn, cur):
+                print(f"✓ Tables already at schema version {SCHEMA_VERSION}")
+            else:
+                print("Configuring tables...")
 
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS icd10_systemic_conditions (
-                id SERIAL PRIMARY KEY,
-                code VARCHAR(20) UNIQUE NOT NULL,
-                description TEXT NOT NULL,
-                category VARCHAR(100),
-                active BOOLEAN DEFAULT TRUE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+                cur.execute(INIT_DDL)
+                cur.execute('SAVEPOINT search_indexes')
+                try:
+                    cur.execute(SEARCH_INDEX_DDL)
+                    cur.execute('RELEASE SAVEPOINT search_indexes')
+                except psycopg2.Error as e:
+                    cur.execute('ROLLBACK TO SAVEPOINT search_indexes')
+                    print(f"⚠️  Patient search indexes skipped (pg_trgm not available): {e}")
+                cur.execute('INSERT INTO schema_version (version) VALUES (%s) ON CONFLICT (version) DO NOTHING',
+                            (SCHEMA_VERSION,))
 
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS medications (
-                id SERIAL PRIMARY KEY,
-                trade_name VARCHAR(255) NOT NULL,
-                generic_name VARCHAR(255) NOT NULL,
-                medication_type VARCHAR(20) CHECK (medication_type IN ('Ocular', 'Systemic', 'Both')),
-                active BOOLEAN DEFAULT TRUE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+                conn.commit()
+                print("✓ Tables configured successfully")
 
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS surgeries (
-                id SERIAL PRIMARY KEY,
-                code VARCHAR(100) UNIQUE NOT NULL,
-                description TEXT NOT NULL,
-                category VARCHAR(100),
-                active BOOLEAN DEFAULT TRUE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+                # Populate reference data in tables
+                populate_reference_data()
 
-        conn.commit()
-        print("✓ Tables configured successfully")
+                # Give the planner statistics for the freshly created and seeded tables
+                # instead of waiting for autovacuum to get round to them
+                with db_connection() as analyze_conn:
+                    try:
+                        analyze_conn.autocommit = True
+                        analyze_conn.cursor().execute('ANALYZE')
+                    except Exception as e:
+                        print(f"⚠️  Could not analyze tables: {e}")
+        finally:
+            # The lock belongs to the session, not the transaction, so a rollback keeps it
+            conn.rollback()
+            cur.execute('SELECT pg_advisory_unlock(%s)', (INIT_DATABASE_LOCK_ID,))
+            conn.commit()
 
         cur.close()
-        conn.close()
-
-        # Populate reference data in tables
-        populate_reference_data()
-
+        release_db_connection(conn)
         return True
 
     except Exception as e:
         print(f"✗ Error initializing database: {e}")
         if conn:
             conn.rollback()
-            conn.close()
+            release_db_connection(conn)
         return False
 
 
@@ -345,11 +874,8 @@ def populate_reference_data():
         # Check and populate default admin user
         cur.execute("SELECT COUNT(*) FROM users")
         if cur.fetchone()[0] == 0:
-            admin_password = bcrypt.generate_password_hash('admin123').decode('utf-8')
-            cur.execute('''
-                INSERT INTO users (username, password_hash, email, role)
-                VALUES (%s, %s, %s, %s)
-            ''', ('Admin', admin_password, '', 'Administrator'))
+            admin_password = hash_password('admin123')
+            cur.execute(INSERT_USER_SQL, ('Admin', admin_password, '', 'Administrator'))
             conn.commit()
             print("✓ Default admin user created (username: Admin, password: admin123)")
             print("  ⚠️  IMPORTANT: Change the admin password after first login!")
@@ -364,14 +890,14 @@ def populate_reference_data():
         populate_surgeries(conn, cur)
 
         cur.close()
-        conn.close()
+        release_db_connection(conn)
         return True
 
     except Exception as e:
         print(f"Error populating reference data: {e}")
         if conn:
             conn.rollback()
-            conn.close()
+            release_db_connection(conn)
         return False
 
 
@@ -388,15 +914,14 @@ def populate_icd10_codes(conn, cur):
 
         if os.path.exists(ocular_file):
             try:
-                import pandas as pd
                 print(f"Importing ICD-10 ocular codes from {ocular_file}...")
 
                 df = pd.read_excel(ocular_file)
                 imported_count = 0
 
-                for _, row in df.iterrows():
-                    code = str(row['ICD-10 Code']).strip()
-                    description = str(row['Description']).strip()
+                for code, description in df[['ICD-10 Code', 'Description']].itertuples(index=False, name=None):
+                    code = str(code).strip()
+                    description = str(description).strip()
 
                     # Determine category based on code prefix
                     category = get_ocular_category(code)
@@ -436,15 +961,14 @@ def populate_icd10_codes(conn, cur):
 
         if os.path.exists(systemic_file):
             try:
-                import pandas as pd
                 print(f"Importing ICD-10 systemic codes from {systemic_file}...")
 
                 df = pd.read_excel(systemic_file)
                 imported_count = 0
 
-                for _, row in df.iterrows():
-                    code = str(row['ICD-10 Code']).strip()
-                    description = str(row['Description']).strip()
+                for code, description in df[['ICD-10 Code', 'Description']].itertuples(index=False, name=None):
+                    code = str(code).strip()
+                    description = str(description).strip()
 
                     # Determine category based on first letter
                     category = get_systemic_category(code)
@@ -633,15 +1157,15 @@ def populate_medications(conn, cur):
             ('Amlodipine', 'Amlodipine', 'Systemic'),
         ]
 
-        for trade, generic, med_type in sample_medications:
-            try:
-                cur.execute('''
-                    INSERT INTO medications (trade_name, generic_name, medication_type, active)
-                    VALUES (%s, %s, %s, TRUE)
-                    ON CONFLICT DO NOTHING
-                ''', (trade, generic, med_type))
-            except Exception as e:
-                print(f"  Error inserting medication {trade}: {e}")
+        # One multi-row INSERT instead of a statement per medication
+        try:
+            execute_values(cur, '''
+                INSERT INTO medications (trade_name, generic_name, medication_type, active)
+                VALUES %s
+                ON CONFLICT DO NOTHING
+            ''', sample_medications, template='(%s, %s, %s, TRUE)', page_size=1000)
+        except Exception as e:
+            print(f"  Error inserting medications: {e}")
 
         conn.commit()
         print(f"✓ Inserted {len(sample_medications)} sample medications")
@@ -680,14 +1204,142 @@ def populate_surgeries(conn, cur):
 
 # Authentication and Utility Functions
 
+# The session cookie only carries user_id; username and role are looked up per
+# process and kept for USER_CACHE_TTL seconds, so a role change or deleted
+# account takes effect within that window.
+User = namedtuple('User', 'user_id username role')
+USER_CACHE_TTL = 60  # seconds
+user_cache = {}  # user_id -> (expiry, User)
+
+
+def cache_user(user):
+    """Remember a user row for USER_CACHE_TTL seconds"""
+    user_cache[user.user_id] = (time.monotonic() + USER_CACHE_TTL, user)
+
+
+def load_user(user_id):
+    """User row for a session's user_id, or None if the account no longer exists"""
+    entry = user_cache.get(user_id)
+    if entry and entry[0] > time.monotonic():
+        return entry[1]
+
+    with db_connection() as conn:
+        if not conn:
+            # Keep serving a stale entry rather than logging everyone out
+            return entry[1] if entry else None
+        conn.autocommit = True
+        cur = conn.shared_cursor()
+        cur.execute('SELECT user_id, username, role FROM users WHERE user_id = %s', (user_id,))
+        row = cur.fetchone()
+
+    if row is None:
+        user_cache.pop(user_id, None)
+        return None
+    user = User._make(row)
+    cache_user(user)
+    return user
+
+
+def lookup_login(cur, username):
+    """
+    (user_id, username, password_hash, role) for a login attempt, or None
+
+    Always read fresh: a password change, reset or deletion made through any
+    worker must take effect on the very next login.
+    """
+    execute_prepared(cur, 'user_by_username', (username,))
+    return cur.fetchone()
+
+
+# last_login is written by a background thread, so a login never waits on
+# that UPDATE. Timestamps still queued when the process exits are lost.
+LAST_LOGIN_BATCH_SIZE = 100
+LAST_LOGIN_BATCH_WAIT = 0.1  # seconds
+last_login_queue = queue.SimpleQueue()
+last_login_writer = None
+last_login_writer_lock = threading.Lock()
+
+
+def _reset_last_login_writer_after_fork():
+    """The writer thread doesn't survive fork(); a worker starts its own on first login"""
+    global last_login_queue, last_login_writer, last_login_writer_lock
+    last_login_queue = queue.SimpleQueue()
+    last_login_writer = None
+    last_login_writer_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_last_login_writer_after_fork)
+
+
+def write_last_logins():
+    """Drain the last_login queue, one UPDATE per batch of up to LAST_LOGIN_BATCH_SIZE logins"""
+    while True:
+        logins = {last_login_queue.get()}
+        deadline = time.monotonic() + LAST_LOGIN_BATCH_WAIT
+        while len(logins) < LAST_LOGIN_BATCH_SIZE:
+            try:
+                logins.add(last_login_queue.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+
+        with db_connection() as conn:
+            if not conn:
+                print(f"Could not record last login for {len(logins)} user(s): no database connection")
+                continue
+            try:
+                cur = conn.cursor()
+                # The server's clock stamps the batch, at most LAST_LOGIN_BATCH_WAIT after the logins
+                cur.execute('UPDATE users SET last_login = CURRENT_TIMESTAMP WHERE user_id = ANY(%s)',
+                            (list(logins),))
+                conn.commit()
+                cur.close()
+            except Exception as e:
+                conn.rollback()
+                print(f"Error recording last login: {e}")
+
+
+def record_last_login(user_id):
+    """Queue a last_login update, starting this process's writer thread if needed"""
+    global last_login_writer
+    last_login_queue.put(user_id)
+    if last_login_writer is None:
+        with last_login_writer_lock:
+            if last_login_writer is None:
+                last_login_writer = threading.Thread(target=write_last_logins, name='last-login-writer', daemon=True)
+                last_login_writer.start()
+
+
+@app.before_request
+def load_logged_in_user():
+    """Resolve the session's user into g.user"""
+    g.user = None
+    user_id = session.get('user_id')
+    if user_id is not None:
+        g.user = load_user(user_id)
+        if g.user is None:
+            session.clear()
+
+
+def access_denied(message, endpoint, status):
+    """
+    Reject a request that failed an access check
+
+    Pages get a flash message and a redirect; API calls get a JSON error
+    instead of following the redirect and rendering a whole page.
+    """
+    if request.path.startswith('/api/'):
+        return jsonify({'error': message}), status
+    flash(message, 'error')
+    return redirect(url_for(endpoint))
+
+
 def login_required(f):
     """Decorator to require login for routes"""
 
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
-            flash('Please log in to access this page.', 'error')
-            return redirect(url_for('login'))
+        if g.user is None:
+            return access_denied('Please log in to access this page.', 'login', 401)
         return f(*args, **kwargs)
 
     return decorated_function
@@ -698,12 +1350,10 @@ def admin_required(f):
 
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
-            flash('Please log in to access this page.', 'error')
-            return redirect(url_for('login'))
-        if session.get('role') != 'Administrator':
-            flash('Administrator access required.', 'error')
-            return redirect(url_for('dashboard'))
+        if g.user is None:
+            return access_denied('Please log in to access this page.', 'login', 401)
+        if g.user.role != 'Administrator':
+            return access_denied('Administrator access required.', 'dashboard', 403)
         return f(*args, **kwargs)
 
     return decorated_function
@@ -714,92 +1364,237 @@ def staff_or_admin_required(f):
 
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
-            flash('Please log in to access this page.', 'error')
-            return redirect(url_for('login'))
-        if session.get('role') not in ['Administrator', 'Staff']:
-            flash('Staff or Administrator access required.', 'error')
-            return redirect(url_for('dashboard'))
+        if g.user is None:
+            return access_denied('Please log in to access this page.', 'login', 401)
+        if g.user.role not in ['Administrator', 'Staff']:
+            return access_denied('Staff or Administrator access required.', 'dashboard', 403)
         return f(*args, **kwargs)
 
     return decorated_function
 
 
+def conditional_json_response(body):
+    """Serialized JSON response tagged with a content ETag; unchanged data is answered with 304 Not Modified"""
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(hashlib.blake2b(response.get_data(), digest_size=16).hexdigest())
+    # Let browsers keep the body but always revalidate it
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+def ocular_condition_values(form, **defaults):
+    """
+    The OCULAR_CONDITION_FIELDS values from a patient form, in column order
+
+    Keyword arguments override a field's default, keyed by form field name.
+    """
+    defaults = {**OCULAR_CONDITION_DEFAULTS, **defaults} if defaults else OCULAR_CONDITION_DEFAULTS
+    return tuple(form.get(key, default) for key, default in defaults.items())
+
+
+def insert_patient_entries(cur, patient_id, form):
+    """
+    Insert a patient form's repeated entries (other conditions, surgeries,
+    systemic conditions, medications) - one multi-row INSERT per table
+
+    An entry whose eye or last-application field is missing from the form is
+    kept with 'ND' (days then default to 0) rather than dropped.
+    """
+    # Other Ocular Conditions (multiple entries possible)
+    other_ocular_conditions = form.getlist('other_ocular_condition[]')
+    other_ocular_eyes = form.getlist('other_ocular_condition_eye[]')
+    rows = [(patient_id, icd10_code, eye_affected)
+            for icd10_code, eye_affected in zip_longest(other_ocular_conditions, other_ocular_eyes, fillvalue='ND')
+            if icd10_code and icd10_code not in ['0', 'ND']]
+    execute_values(cur, '''
+        INSERT INTO other_ocular_conditions (patient_id, icd10_code, eye) VALUES %s
+    ''', rows, page_size=200)
+
+    # Previous Ocular Surgeries (multiple entries possible)
+    surgeries_list = form.getlist('previous_surgery[]')
+    surgeries_eyes = form.getlist('previous_surgery_eye[]')
+    rows = [(patient_id, surgery_code, eye_affected)
+            for surgery_code, eye_affected in zip_longest(surgeries_list, surgeries_eyes, fillvalue='ND')
+            if surgery_code and surgery_code not in ['0', 'ND']]
+    execute_values(cur, '''
+        INSERT INTO previous_ocular_surgeries (patient_id, surgery_code, eye) VALUES %s
+    ''', rows, page_size=200)
+
+    # Systemic Conditions (multiple entries possible)
+    systemic_conditions_list = form.getlist('systemic_condition[]')
+    rows = [(patient_id, icd10_code)
+            for icd10_code in systemic_conditions_list
+            if icd10_code and icd10_code not in ['0', 'ND']]
+    execute_values(cur, '''
+        INSERT INTO systemic_conditions (patient_id, icd10_code) VALUES %s
+    ''', rows, page_size=200)
+
+    # Ocular Medications (multiple entries possible)
+    ocular_meds_list = form.getlist('ocular_medication[]')
+    ocular_meds_eyes = form.getlist('ocular_medication_eye[]')
+    ocular_meds_days = form.getlist('ocular_medication_days[]')
+
+    rows = []
+    for medication, eye_affected, last_app in zip_longest(ocular_meds_list, ocular_meds_eyes, ocular_meds_days,
+                                                          fillvalue='ND'):
+        if medication and medication not in ['0', 'ND']:
+            # Split medication into trade_name|generic_name
+            parts = medication.split('|')
+            if len(parts) == 2:
+                trade_name, generic_name = parts
+                # Default to 0 if blank or invalid
+                if last_app and last_app.strip() and last_app.isdigit():
+                    last_application_days = int(last_app)
+                else:
+                    last_application_days = 0  # Default to 0
+                rows.append((patient_id, trade_name, generic_name, eye_affected, last_application_days))
+    execute_values(cur, '''
+        INSERT INTO ocular_medications (patient_id, trade_name, generic_name, eye, last_application_days)
+        VALUES %s
+    ''', rows, page_size=200)
+
+    # Systemic Medications (multiple entries possible)
+    systemic_meds_list = form.getlist('systemic_medication[]')
+    systemic_meds_days = form.getlist('systemic_medication_days[]')
+
+    rows = []
+    for medication, last_app in zip_longest(systemic_meds_list, systemic_meds_days, fillvalue='ND'):
+        if medication and medication not in ['0', 'ND']:
+            # Split medication into trade_name|generic_name
+            parts = medication.split('|')
+            if len(parts) == 2:
+                trade_name, generic_name = parts
+                # Default to 0 if blank or invalid
+                if last_app and last_app.strip() and last_app.isdigit():
+                    last_application_days = int(last_app)
+                else:
+                    last_application_days = 0  # Default to 0
+                rows.append((patient_id, trade_name, generic_name, last_application_days))
+    execute_values(cur, '''
+        INSERT INTO systemic_medications (patient_id, trade_name, generic_name, last_application_days)
+        VALUES %s
+    ''', rows, page_size=200)
+
+
+@lru_cache(maxsize=65536)
+def _sha256_hex(value):
+    """SHA-256 hex digest (OpenSSL-backed, uses SHA-NI where the CPU has it); memoized per process"""
+    return hashlib.sha256(value.encode('utf-8')).hexdigest()
+
+
 def generate_person_hash(mbo):
-    """Generate SHA-256 hash from MBO"""
-    return hashlib.sha256(mbo.encode()).hexdigest()
+    """Generate SHA-256 hash from MBO (None only if there is no MBO at all)"""
+    # A blank MBO is hashed like any other string, as insert_patient's sha256() does
+    if mbo is None:
+        return None
+    return _sha256_hex(mbo)
 
 
 def calculate_age(date_of_birth, date_of_sample):
     """Calculate age at sample collection"""
     if not date_of_birth or not date_of_sample:
         return None
-    age = date_of_sample.year - date_of_birth.year
-    if (date_of_sample.month, date_of_sample.day) < (date_of_birth.month, date_of_birth.day):
-        age -= 1
-    return age
+    # Pack each date as year:month:day bit fields (day < 32, month * 32 + day < 512);
+    # the month/day part of the difference only ever borrows one from the years,
+    # exactly when the birthday hasn't come round yet that year
+    sample = (date_of_sample.year << 9) | (date_of_sample.month << 5) | date_of_sample.day
+    birth = (date_of_birth.year << 9) | (date_of_birth.month << 5) | date_of_birth.day
+    return (sample - birth) >> 9
 
 
-def get_next_available_patient_id():
-    """Get next available patient ID - finds the lowest available ID starting from STARTING_PATIENT_ID"""
-    conn = get_db_connection()
-    if not conn:
+def calculate_ages(dates_of_birth, dates_of_sample):
+    """
+    calculate_age() over whole columns at once (bulk imports)
+
+    The same packed-date arithmetic as calculate_age(), run as numpy array
+    operations on the year/month/day components instead of a Python call per
+    row; missing or unparseable dates give <NA>. datetime64 columns are used
+    as they are; anything else (date objects, strings) is parsed first.
+    Returns a nullable Int64 Series.
+    """
+    def packed(dates):
+        dates = pd.Series(dates)
+        if not pd.api.types.is_datetime64_any_dtype(dates):
+            dates = pd.to_datetime(dates.astype(object), errors='coerce')
+        return dates.dt.year * 512 + dates.dt.month * 32 + dates.dt.day
+
+    return ((packed(dates_of_sample) - packed(dates_of_birth)) // 512).astype('Int64')
+
+
+def bulk_hash_and_age(mbos, dates_of_birth, dates_of_sample):
+    """person_hash list and age Series for a batch of patients"""
+    return [generate_person_hash(mbo) for mbo in mbos], calculate_ages(dates_of_birth, dates_of_sample)
+
+
+def fetch_next_patient_id(conn):
+    """Next available patient ID read on an already checked-out connection (None if out of IDs)"""
+    cur = conn.cursor()
+    cur.execute(f'SELECT {NEXT_PATIENT_ID_SQL} AS next_id',
+                (STARTING_PATIENT_ID, STARTING_PATIENT_ID))
+
+    result = cur.fetchone()
+    next_id = result[0] if result else STARTING_PATIENT_ID
+    cur.close()
+
+    # Make sure we don't exceed the maximum allowed ID
+    if next_id > 99999:
         return None
-    try:
-        cur = conn.cursor()
+    return next_id
 
-        # Find the smallest available ID starting from STARTING_PATIENT_ID
-        # This query finds gaps in the sequence
-        cur.execute("""
-            SELECT COALESCE(
-                (SELECT MIN(t1.patient_id + 1)
-                 FROM patients_sensitive t1
-                 WHERE NOT EXISTS (
-                     SELECT 1 FROM patients_sensitive t2
-                     WHERE t2.patient_id = t1.patient_id + 1
-                 )
-                 AND t1.patient_id >= %s),
-                %s
-            ) AS next_id
-        """, (STARTING_PATIENT_ID, STARTING_PATIENT_ID))
-
-        result = cur.fetchone()
-        next_id = result[0] if result else STARTING_PATIENT_ID
-
-        # Make sure we don't exceed the maximum allowed ID
-        if next_id > 99999:
-            cur.close()
-            conn.close()
+
+def get_next_available_patient_id():
+    """Get next available patient ID - finds the lowest available ID starting from STARTING_PATIENT_ID"""
+    with db_connection() as conn:
+        if not conn:
+            return None
+        try:
+            return fetch_next_patient_id(conn)
+        except Exception as e:
+            print(f"Error getting next patient ID: {e}")
             return None
 
-        cur.close()
-        conn.close()
-        return next_id
-    except Exception as e:
-        print(f"Error getting next patient ID: {e}")
-        if conn:
-            conn.close()
-        return None
 
+# patient_id -> expiry of a recent "not taken" answer from patient_id_taken()
+FREE_PATIENT_ID_TTL = 2  # seconds
+free_patient_ids = {}
 
-def check_patient_id_exists(patient_id):
-    """Check if patient ID already exists"""
-    conn = get_db_connection()
-    if not conn:
-        return False
-    try:
-        cur = conn.cursor()
-        cur.execute("SELECT COUNT(*) FROM patients_sensitive WHERE patient_id = %s", (patient_id,))
-        exists = cur.fetchone()[0] > 0
-        cur.close()
-        conn.close()
-        return exists
-    except Exception as e:
-        print(f"Error checking patient ID: {e}")
-        if conn:
-            conn.close()
+
+def patient_id_taken(patient_id):
+    """
+    Whether a patient ID is already in use (None if the database is unreachable)
+
+    "Free" answers are remembered for FREE_PATIENT_ID_TTL seconds, so the
+    availability check fired while an ID is being typed doesn't reach the
+    database on every keystroke; the insert still rejects a taken ID.
+    """
+    expiry = free_patient_ids.get(patient_id)
+    if expiry and expiry > time.monotonic():
         return False
 
+    with db_connection() as conn:
+        if not conn:
+            return None
+        conn.autocommit = True
+        cur = conn.shared_cursor()
+        execute_prepared(cur, 'patient_id_exists', (patient_id,))
+        taken = cur.fetchone()[0]
+
+    if taken:
+        free_patient_ids.pop(patient_id, None)
+    else:
+        if len(free_patient_ids) > 1000:
+            free_patient_ids.clear()
+        free_patient_ids[patient_id] = time.monotonic() + FREE_PATIENT_ID_TTL
+    return taken
+
+
+def patient_id_check_response(response, status=200):
+    """Let the browser reuse an availability answer as long as the server would"""
+    response = app.make_response((response, status))
+    response.cache_control.private = True
+    response.cache_control.max_age = FREE_PATIENT_ID_TTL
+    return response
+
 
 def build_filter_clause(request_form):
     """
@@ -1351,13 +2146,13 @@ def init_icd10_from_excel():
             conn.commit()
 
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
     except Exception as e:
         print(f"Error initializing ICD-10 codes: {e}")
         if conn:
             conn.rollback()
-            conn.close()
+            release_db_connection(conn)
 
 
 # Dynamic Generic Component Extraction for reporting purposes
@@ -1394,14 +2189,14 @@ def get_all_generic_components():
                     all_generics.add(component)
 
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
         return all_generics
 
     except Exception as e:
         print(f"Error getting generic components: {e}")
         if conn:
-            conn.close()
+            release_db_connection(conn)
         return set()
 
 
@@ -1434,7 +2229,6 @@ def extract_generic_components_dynamic(medications_list, all_generic_components)
 def make_safe_column_name(name):
     """Convert a string to a safe column name"""
     # Replace special characters with underscores
-    import re
     safe_name = re.sub(r'[^a-zA-Z0-9]', '_', str(name))
     # Remove multiple underscores
     safe_name = re.sub(r'_+', '_', safe_name)
@@ -1443,21 +2237,19 @@ def make_safe_column_name(name):
     return safe_name.lower()
 
 
-def initialize_app():
-    """Initialize the application - runs once when module is loaded"""
-    print("\n" + "=" * 60)
-    print("RAMAN MEDICAL RESEARCH DATABASE - Starting Up")
-    print("=" * 60 + "\n")
-
+def prepare_database():
+    """Create the database, tables and reference data as needed; True if all went well"""
     # Step 1: Check/Create database
     print("Step 1: Checking database existence...")
-    if not create_database_if_not_exists():
+    ok = create_database_if_not_exists()
+    if not ok:
         print("\n✗ Failed to create/access database. Continuing anyway...")
         # Don't exit - let the app start but log the error
 
     # Step 2: Initialize tables
     print("\nStep 2: Initializing database tables...")
     if not init_database():
+        ok = False
         print("\n✗ Warning: Database initialization had issues")
         print("The application may not work correctly.\n")
     else:
@@ -1466,12 +2258,41 @@ def initialize_app():
     # Step 3: Ensure reference data is populated (even if tables already exist)
     print("\nStep 3: Checking and populating reference data...")
     try:
-        populate_reference_data()
+        if populate_reference_data() is False:
+            ok = False
     except Exception as e:
+        ok = False
         print(f"⚠ Warning: Error populating reference data: {e}")
-        import traceback
         traceback.print_exc()
 
+    return ok
+
+
+# Set to False when the deploy runs `flask --app app init-db` once beforehand
+DB_INIT_ON_STARTUP = os.getenv('DB_INIT_ON_STARTUP', 'True').lower() in ('1', 'true')
+
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create the database, tables and reference data, then exit"""
+    ok = prepare_database()
+    close_db_pool()
+    if not ok:
+        raise SystemExit(1)
+
+
+def initialize_app():
+    """Initialize the application - runs once when module is loaded"""
+    print("\n" + "=" * 60)
+    print("RAMAN MEDICAL RESEARCH DATABASE - Starting Up")
+    print("=" * 60 + "\n")
+
+    # Steps 1-3: database, tables and reference data
+    if DB_INIT_ON_STARTUP:
+        prepare_database()
+    else:
+        print("ℹ Skipping database initialization (DB_INIT_ON_STARTUP is off; run `flask --app app init-db`)")
+
     # Step 4: Initialize backup scheduler
     print("\nStep 4: Checking backup scheduler configuration...")
 
@@ -1500,6 +2321,10 @@ def initialize_app():
     else:
         print(f"ℹ Skipping scheduler initialization in worker {worker_id} (already running in another worker)")
 
+    # Gunicorn forks workers from this process (preload_app), so don't leave
+    # startup connections open for them to inherit
+    close_db_pool()
+
     print("\n" + "=" * 60)
     print("✓ Application initialization complete!")
     print("=" * 60 + "\n")
@@ -1514,7 +2339,6 @@ if not _initialized:
         _initialized = True
     except Exception as e:
         print(f"Critical initialization error: {e}")
-        import traceback
         traceback.print_exc()
         # Still set as initialized to prevent retry loops
         _initialized = True
@@ -1530,6 +2354,26 @@ def index():
     return redirect(url_for('login'))
 
 
+# Without a pending flash message the login page is the same for everyone, so each
+# process renders it once: (html, etag)
+login_page_cache = None
+
+
+def login_page():
+    """The login page, served from memory unless a flashed message has to be shown"""
+    global login_page_cache
+    if '_flashes' in session:
+        return render_template('login.html')
+    if login_page_cache is None:
+        html = render_template('login.html')
+        login_page_cache = (html, hashlib.blake2b(html.encode('utf-8'), digest_size=16).hexdigest())
+    html, etag = login_page_cache
+    response = app.make_response(html)
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     """User login"""
@@ -1540,40 +2384,37 @@ def login():
         username = request.form.get('username')
         password = request.form.get('password')
 
-        conn = get_db_connection()
-        if not conn:
-            flash('Database connection error', 'error')
-            return render_template('login.html')
-
-        try:
-            cur = conn.cursor(cursor_factory=RealDictCursor)
-            cur.execute('SELECT * FROM users WHERE username = %s', (username,))
-            user = cur.fetchone()
-
-            if user and bcrypt.check_password_hash(user['password_hash'], password):
-                session['user_id'] = user['user_id']
-                session['username'] = user['username']
-                session['role'] = user['role']
+        with db_connection() as conn:
+            if not conn:
+                flash('Database connection error', 'error')
+                return render_template('login.html')
 
-                # Update last login
-                cur.execute('UPDATE users SET last_login = CURRENT_TIMESTAMP WHERE user_id = %s', (user['user_id'],))
-                conn.commit()
-
-                cur.close()
-                conn.close()
-
-                flash(f'Welcome back, {username}!', 'success')
-                return redirect(url_for('dashboard'))
-            else:
-                flash('Invalid username or password', 'error')
-                cur.close()
-                conn.close()
-        except Exception as e:
-            flash(f'Login error: {str(e)}', 'error')
-            if conn:
-                conn.close()
+            try:
+                # Both statements stand alone - no BEGIN/COMMIT round trips around them
+                conn.autocommit = True
+                cur = conn.shared_cursor()
+                user = lookup_login(cur, username)
+
+                if user and verify_login(username, password, user[2]):
+                    user_id, db_username, _, role = user
+                    session['user_id'] = user_id
+                    cache_user(User(user_id, db_username, role))
+
+                    # Update last login (only after the password checked out), upgrading
+                    # a legacy/outdated hash now that the plain password is at hand
+                    record_last_login(user_id)
+                    if password_needs_rehash(user[2]):
+                        cur.execute('UPDATE users SET password_hash = %s WHERE user_id = %s',
+                                    (hash_password(password), user_id))
+
+                    flash(f'Welcome back, {username}!', 'success')
+                    return redirect(url_for('dashboard'))
+                else:
+                    flash('Invalid username or password', 'error')
+            except Exception as e:
+                flash(f'Login error: {str(e)}', 'error')
 
-    return render_template('login.html')
+    return login_page()
 
 
 @app.route('/logout')
@@ -1584,10 +2425,27 @@ def logout():
     return redirect(url_for('login'))
 
 
+# The dashboard figures are shared by every user and only need to be roughly
+# current, so each process recomputes them at most every DASHBOARD_STATS_TTL seconds
+DASHBOARD_STATS_TTL = 10  # seconds
+dashboard_stats_cache = None  # (expiry, stats)
+
+
+def forget_dashboard_stats():
+    """Recompute the dashboard figures on the next visit (after adding/removing patients here)"""
+    global dashboard_stats_cache
+    dashboard_stats_cache = None
+
+
 @app.route('/dashboard')
 @login_required
 def dashboard():
     """Main dashboard"""
+    global dashboard_stats_cache
+    cached = dashboard_stats_cache
+    if cached and cached[0] > time.monotonic():
+        return render_template('dashboard.html', stats=cached[1])
+
     conn = get_db_connection()
     if not conn:
         flash('Database connection error', 'error')
@@ -1596,60 +2454,59 @@ def dashboard():
     try:
         cur = conn.cursor(cursor_factory=RealDictCursor)
 
-        # Get statistics
-        cur.execute('SELECT COUNT(*) as total FROM patients_sensitive')
-        total_patients = cur.fetchone()['total']
-
-        cur.execute('SELECT COUNT(*) as total FROM users')
-        total_users = cur.fetchone()['total']
-
-        # Get next available patient ID (based on actual database content)
-        next_patient_id = get_next_available_patient_id()
-
-        stats = {
-            'total_patients': total_patients,
-            'total_users': total_users,
-            'next_patient_id': next_patient_id
-        }
+        # Get statistics and the next available patient ID in a single round trip.
+        # Large patient tables use the pg_class estimate (kept current by autovacuum);
+        # the COUNT(*) subquery only runs when its CASE branch is taken.
+        cur.execute(f'''
+            SELECT
+                CASE WHEN est.n >= %s THEN est.n
+                     ELSE (SELECT COUNT(*) FROM patients_sensitive)
+                END AS total_patients,
+                est.n >= %s AS total_patients_estimated,
+                (SELECT COUNT(*) FROM users) AS total_users,
+                {NEXT_PATIENT_ID_SQL} AS next_patient_id
+            FROM (SELECT reltuples::bigint AS n FROM pg_class
+                  WHERE oid = 'patients_sensitive'::regclass) est
+        ''', (DASHBOARD_EXACT_COUNT_LIMIT, DASHBOARD_EXACT_COUNT_LIMIT,
+              STARTING_PATIENT_ID, STARTING_PATIENT_ID))
+        stats = dict(cur.fetchone())
+
+        # Same limit as get_next_available_patient_id()
+        if stats['next_patient_id'] > 99999:
+            stats['next_patient_id'] = None
 
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
+        dashboard_stats_cache = (time.monotonic() + DASHBOARD_STATS_TTL, stats)
         return render_template('dashboard.html', stats=stats)
     except Exception as e:
         flash(f'Error loading dashboard: {str(e)}', 'error')
         if conn:
-            conn.close()
+            release_db_connection(conn)
         return render_template('dashboard.html', stats={})
 
 
-@app.route('/api/check-patient-id/<int:patient_id>')
+@app.route('/api/check-patient-id/<int:patient_id>', methods=['GET', 'HEAD'])
 @staff_or_admin_required
 def api_check_patient_id(patient_id):
-    """API endpoint to check if patient ID exists"""
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({'error': 'Database connection failed', 'exists': True}), 500
-
+    """API endpoint to check if patient ID exists (HEAD: 204 if free, 409 if taken)"""
     try:
-        cur = conn.cursor()
-        cur.execute("SELECT COUNT(*) FROM patients_sensitive WHERE patient_id = %s", (patient_id,))
-        count = cur.fetchone()[0]
-        exists = count > 0
-
-        cur.close()
-        conn.close()
-
-        return jsonify({
-            'exists': exists,
-            'patient_id': patient_id,
-            'available': not exists
-        })
+        exists = patient_id_taken(patient_id)
     except Exception as e:
         print(f"[API] Error checking patient ID {patient_id}: {e}")
-        if conn:
-            conn.close()
         return jsonify({'error': str(e), 'exists': True}), 500
+    if exists is None:
+        return jsonify({'error': 'Database connection failed', 'exists': True}), 500
+
+    if request.method == 'HEAD':
+        return patient_id_check_response('', 409 if exists else 204)
+
+    return patient_id_check_response(jsonify({
+        'exists': exists,
+        'patient_id': patient_id,
+        'available': not exists
+    }))
 
 
 @app.route('/api/next-patient-id')
@@ -1669,37 +2526,38 @@ def api_next_patient_id():
 def new_patient():
     """Create new patient record"""
     if request.method == 'GET':
-        # Get reference data for dropdowns
-        conn = get_db_connection()
-        if not conn:
-            flash('Database connection error', 'error')
-            return redirect(url_for('dashboard'))
-
         try:
-            cur = conn.cursor(cursor_factory=RealDictCursor)
+            # Reference data for the dropdowns and the next free patient ID, read
+            # in one round trip with no transaction (nothing is written)
+            with db_cursor() as cur:
+                if cur is None:
+                    flash('Database connection error', 'error')
+                    return redirect(url_for('dashboard'))
 
-            # Get ICD-10 ocular conditions
-            cur.execute('SELECT code, description FROM icd10_ocular_conditions WHERE active = TRUE ORDER BY code')
-            icd10_ocular = cur.fetchall()
-
-            # Get ICD-10 systemic conditions
-            cur.execute('SELECT code, description FROM icd10_systemic_conditions WHERE active = TRUE ORDER BY code')
-            icd10_systemic = cur.fetchall()
-
-            # Get medications
-            cur.execute(
-                'SELECT trade_name, generic_name, medication_type FROM medications WHERE active = TRUE ORDER BY trade_name')
-            medications = cur.fetchall()
-
-            # Get surgeries
-            cur.execute('SELECT code, description FROM surgeries WHERE active = TRUE ORDER BY code')
-            surgeries = cur.fetchall()
-
-            # Get next patient ID based on actual database content
-            next_id = get_next_available_patient_id()
-
-            cur.close()
-            conn.close()
+                cur.execute(f'''
+                    SELECT {NEXT_PATIENT_ID_SQL} AS next_id,
+                           (SELECT COALESCE(json_agg(r ORDER BY r.code), '[]') FROM (
+                                SELECT code, description FROM icd10_ocular_conditions WHERE active = TRUE) r
+                           ) AS icd10_ocular,
+                           (SELECT COALESCE(json_agg(r ORDER BY r.code), '[]') FROM (
+                                SELECT code, description FROM icd10_systemic_conditions WHERE active = TRUE) r
+                           ) AS icd10_systemic,
+                           (SELECT COALESCE(json_agg(r ORDER BY r.trade_name), '[]') FROM (
+                                SELECT trade_name, generic_name, medication_type FROM medications WHERE active = TRUE) r
+                           ) AS medications,
+                           (SELECT COALESCE(json_agg(r ORDER BY r.code), '[]') FROM (
+                                SELECT code, description FROM surgeries WHERE active = TRUE) r
+                           ) AS surgeries
+                ''', (STARTING_PATIENT_ID, STARTING_PATIENT_ID))
+                row = cur.fetchone()
+
+            icd10_ocular = row['icd10_ocular']
+            icd10_systemic = row['icd10_systemic']
+            medications = row['medications']
+            surgeries = row['surgeries']
+
+            # Make sure we don't exceed the maximum allowed ID
+            next_id = row['next_id'] if row['next_id'] <= 99999 else None
 
             # Prepare stats with default values (in case template needs them)
             stats = {
@@ -1717,8 +2575,6 @@ def new_patient():
                                    stats=stats)
         except Exception as e:
             flash(f'Error loading form: {str(e)}', 'error')
-            if conn:
-                conn.close()
             return redirect(url_for('dashboard'))
 
     # POST - save new patient
@@ -1729,200 +2585,67 @@ def new_patient():
 
     try:
         cur = conn.cursor()
-
-        # Get form data - General Data
-        patient_id = int(request.form.get('patient_id'))
-        patient_name = request.form.get('patient_name')
-        mbo = request.form.get('mbo')
-        sex = request.form.get('sex')
+        if ASYNC_PATIENT_COMMIT:
+            # Applies to this transaction only; a lost save is lost whole, never half applied
+            cur.execute('SET LOCAL synchronous_commit = OFF')
+
+        # Get form data - General Data (a plain dict for the single-valued fields;
+        # the repeated fields below still come from request.form.getlist)
+        form = request.form.to_dict(flat=True)
+        # Left blank, the insert assigns the next free ID
+        patient_id = form.get('patient_id')
+        patient_id = int(patient_id) if patient_id else None
+        patient_name = form.get('patient_name')
+        mbo = form.get('mbo')
+        sex = form.get('sex')
 
         # Parse dates from separate day/month/year fields
-        dob_day = request.form.get('dob_day')
-        dob_month = request.form.get('dob_month')
-        dob_year = request.form.get('dob_year')
+        dob_day = form.get('dob_day')
+        dob_month = form.get('dob_month')
+        dob_year = form.get('dob_year')
         if dob_day and dob_month and dob_year:
             date_of_birth = date(int(dob_year), int(dob_month), int(dob_day))
         else:
             date_of_birth = None
 
-        collection_day = request.form.get('collection_day')
-        collection_month = request.form.get('collection_month')
-        collection_year = request.form.get('collection_year')
+        collection_day = form.get('collection_day')
+        collection_month = form.get('collection_month')
+        collection_year = form.get('collection_year')
         if collection_day and collection_month and collection_year:
             date_of_sample_collection = date(int(collection_year), int(collection_month), int(collection_day))
         else:
             date_of_sample_collection = None
 
-        eye = request.form.get('eye')
+        eye = form.get('eye')
 
-        # Check if patient ID already exists
-        if check_patient_id_exists(patient_id):
-            flash(f'Patient ID {patient_id} already exists. Please use a different ID.', 'error')
-            conn.close()
-            return redirect(url_for('new_patient'))
-
-        # Generate person hash and calculate age
-        person_hash = generate_person_hash(mbo)
+        # Calculate age (the person hash is computed by the insert itself)
         age = calculate_age(date_of_birth, date_of_sample_collection)
 
-        # Insert into patients_sensitive
-        cur.execute('''
-            INSERT INTO patients_sensitive (patient_id, patient_name, mbo, date_of_birth, date_of_sample_collection)
-            VALUES (%s, %s, %s, %s, %s)
-        ''', (patient_id, patient_name, mbo, date_of_birth, date_of_sample_collection))
+        # Insert patients_sensitive, patients_statistical and ocular_conditions in one
+        # statement; a taken patient ID hits ON CONFLICT DO NOTHING, so there is no
+        # separate existence check to race against
+        execute_prepared(cur, 'insert_patient', (
+            patient_id, patient_name, mbo, date_of_birth, date_of_sample_collection,
+            age, sex, eye) + ocular_condition_values(form))
+        inserted = cur.fetchone()
+        if inserted is None:
+            conn.rollback()
+            if patient_id is None:
+                flash('The next free patient ID was just taken by another user. Please save again.', 'error')
+            else:
+                flash(f'Patient ID {patient_id} already exists. Please use a different ID.', 'error')
+            release_db_connection(conn)
+            return redirect(url_for('new_patient'))
+        patient_id, = inserted
 
-        # Insert into patients_statistical
-        cur.execute('''
-            INSERT INTO patients_statistical (patient_id, person_hash, age, sex, eye)
-            VALUES (%s, %s, %s, %s, %s)
-        ''', (patient_id, person_hash, age, sex, eye))
-
-        # Main Ocular Conditions
-        lens_status = request.form.get('lens_status', 'ND')
-        locs_iii_no = request.form.get('locs_no', 'ND')
-        locs_iii_nc = request.form.get('locs_nc', 'ND')
-        locs_iii_c = request.form.get('locs_c', 'ND')
-        locs_iii_p = request.form.get('locs_p', 'ND')
-        iol_type = request.form.get('iol_type', 'ND')
-        etiology_aphakia = request.form.get('aphakia_etiology', 'ND')
-
-        glaucoma = request.form.get('glaucoma', 'ND')
-        oht_or_pac = request.form.get('oht_or_pac', 'ND')
-        etiology_glaucoma = request.form.get('glaucoma_etiology', 'ND')
-        steroid_responder = request.form.get('steroid_responder', 'ND')
-        pxs = request.form.get('pxs', '0')
-        pds = request.form.get('pds', '0')
-
-        diabetic_retinopathy = request.form.get('diabetic_retinopathy', '0')
-        stage_diabetic_retinopathy = request.form.get('dr_stage', 'ND')
-        stage_npdr = request.form.get('npdr_stage', 'ND')
-        stage_pdr = request.form.get('pdr_stage', 'ND')
-
-        macular_edema = request.form.get('macular_edema', '0')
-        etiology_macular_edema = request.form.get('me_etiology', 'ND')
-
-        macular_degeneration_dystrophy = request.form.get('macular_degeneration', '0')
-        etiology_macular_deg_dyst = request.form.get('md_etiology', 'ND')
-        stage_amd = request.form.get('amd_stage', 'ND')
-        exudation_amd = request.form.get('amd_exudation', 'ND')
-        stage_other_macular_deg = request.form.get('other_md_stage', 'ND')
-        exudation_other_macular_deg = request.form.get('other_md_exudation', 'ND')
-
-        macular_hole_vmt = request.form.get('mh_vmt', '0')
-        etiology_mh_vmt = request.form.get('mh_vmt_etiology', 'ND')
-        cause_secondary_mh_vmt = request.form.get('secondary_mh_vmt_cause', 'ND')
-        treatment_status_mh_vmt = request.form.get('mh_vmt_treatment_status', 'ND')
-
-        epiretinal_membrane = request.form.get('epiretinal_membrane', '0')
-        etiology_erm = request.form.get('erm_etiology', 'ND')
-        cause_secondary_erm = request.form.get('secondary_erm_cause', 'ND')
-        treatment_status_erm = request.form.get('erm_treatment_status', 'ND')
-
-        retinal_detachment = request.form.get('retinal_detachment', '0')
-        etiology_rd = request.form.get('rd_etiology', 'ND')
-        treatment_status_rd = request.form.get('rd_treatment_status', 'ND')
-        pvr = request.form.get('pvr', 'ND')
-
-        vitreous_haemorrhage_opacification = request.form.get('vitreous_opacification', '0')
-        etiology_vitreous_haemorrhage = request.form.get('vh_etiology', 'ND')
-
-        # Insert ocular conditions
-        cur.execute('''
-            INSERT INTO ocular_conditions (
-                patient_id, lens_status, locs_iii_no, locs_iii_nc, locs_iii_c, locs_iii_p,
-                iol_type, etiology_aphakia, glaucoma, oht_or_pac, etiology_glaucoma,
-                steroid_responder, pxs, pds, diabetic_retinopathy, stage_diabetic_retinopathy,
-                stage_npdr, stage_pdr, macular_edema, etiology_macular_edema,
-                macular_degeneration_dystrophy, etiology_macular_deg_dyst, stage_amd, exudation_amd,
-                stage_other_macular_deg, exudation_other_macular_deg, macular_hole_vmt, etiology_mh_vmt,
-                cause_secondary_mh_vmt, treatment_status_mh_vmt, epiretinal_membrane, etiology_erm,
-                cause_secondary_erm, treatment_status_erm, retinal_detachment, etiology_rd,
-                treatment_status_rd, pvr, vitreous_haemorrhage_opacification, etiology_vitreous_haemorrhage
-            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-                      %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        ''', (patient_id, lens_status, locs_iii_no, locs_iii_nc, locs_iii_c, locs_iii_p,
-              iol_type, etiology_aphakia, glaucoma, oht_or_pac, etiology_glaucoma,
-              steroid_responder, pxs, pds, diabetic_retinopathy, stage_diabetic_retinopathy,
-              stage_npdr, stage_pdr, macular_edema, etiology_macular_edema,
-              macular_degeneration_dystrophy, etiology_macular_deg_dyst, stage_amd, exudation_amd,
-              stage_other_macular_deg, exudation_other_macular_deg, macular_hole_vmt, etiology_mh_vmt,
-              cause_secondary_mh_vmt, treatment_status_mh_vmt, epiretinal_membrane, etiology_erm,
-              cause_secondary_erm, treatment_status_erm, retinal_detachment, etiology_rd,
-              treatment_status_rd, pvr, vitreous_haemorrhage_opacification, etiology_vitreous_haemorrhage))
-
-        # Other Ocular Conditions (multiple entries possible)
-        other_ocular_conditions = request.form.getlist('other_ocular_condition[]')
-        other_ocular_eyes = request.form.getlist('other_ocular_condition_eye[]')
-        for icd10_code, eye_affected in zip(other_ocular_conditions, other_ocular_eyes):
-            if icd10_code and icd10_code not in ['0', 'ND']:
-                cur.execute('''
-                    INSERT INTO other_ocular_conditions (patient_id, icd10_code, eye)
-                    VALUES (%s, %s, %s)
-                ''', (patient_id, icd10_code, eye_affected))
-
-        # Previous Ocular Surgeries (multiple entries possible)
-        surgeries_list = request.form.getlist('previous_surgery[]')
-        surgeries_eyes = request.form.getlist('previous_surgery_eye[]')
-        for surgery_code, eye_affected in zip(surgeries_list, surgeries_eyes):
-            if surgery_code and surgery_code not in ['0', 'ND']:
-                cur.execute('''
-                    INSERT INTO previous_ocular_surgeries (patient_id, surgery_code, eye)
-                    VALUES (%s, %s, %s)
-                ''', (patient_id, surgery_code, eye_affected))
-
-        # Systemic Conditions (multiple entries possible)
-        systemic_conditions_list = request.form.getlist('systemic_condition[]')
-        for icd10_code in systemic_conditions_list:
-            if icd10_code and icd10_code not in ['0', 'ND']:
-                cur.execute('''
-                    INSERT INTO systemic_conditions (patient_id, icd10_code)
-                    VALUES (%s, %s)
-                ''', (patient_id, icd10_code))
-
-        # Ocular Medications (multiple entries possible)
-        ocular_meds_list = request.form.getlist('ocular_medication[]')
-        ocular_meds_eyes = request.form.getlist('ocular_medication_eye[]')
-        ocular_meds_days = request.form.getlist('ocular_medication_days[]')
-
-        for medication, eye_affected, last_app in zip(ocular_meds_list, ocular_meds_eyes, ocular_meds_days):
-            if medication and medication not in ['0', 'ND']:
-                # Split medication into trade_name|generic_name
-                parts = medication.split('|')
-                if len(parts) == 2:
-                    trade_name, generic_name = parts
-                    # Default to 0 if blank or invalid
-                    if last_app and last_app.strip() and last_app.isdigit():
-                        last_application_days = int(last_app)
-                    else:
-                        last_application_days = 0  # Default to 0
-                    cur.execute('''
-                        INSERT INTO ocular_medications (patient_id, trade_name, generic_name, eye, last_application_days)
-                        VALUES (%s, %s, %s, %s, %s)
-                    ''', (patient_id, trade_name, generic_name, eye_affected, last_application_days))
-
-        # Systemic Medications (multiple entries possible)
-        systemic_meds_list = request.form.getlist('systemic_medication[]')
-        systemic_meds_days = request.form.getlist('systemic_medication_days[]')
-
-        for medication, last_app in zip(systemic_meds_list, systemic_meds_days):
-            if medication and medication not in ['0', 'ND']:
-                # Split medication into trade_name|generic_name
-                parts = medication.split('|')
-                if len(parts) == 2:
-                    trade_name, generic_name = parts
-                    # Default to 0 if blank or invalid
-                    if last_app and last_app.strip() and last_app.isdigit():
-                        last_application_days = int(last_app)
-                    else:
-                        last_application_days = 0  # Default to 0
-                    cur.execute('''
-                        INSERT INTO systemic_medications (patient_id, trade_name, generic_name, last_application_days)
-                        VALUES (%s, %s, %s, %s)
-                    ''', (patient_id, trade_name, generic_name, last_application_days))
+        # Other conditions, surgeries and medications, one round trip per table
+        insert_patient_entries(cur, patient_id, request.form)
 
         conn.commit()
         cur.close()
-        conn.close()
+        release_db_connection(conn)
+        free_patient_ids.pop(patient_id, None)
+        forget_dashboard_stats()
 
         flash(f'Patient #{patient_id:05d} - {patient_name} has been added successfully!', 'success')
         return redirect(url_for('dashboard'))
@@ -1931,7 +2654,7 @@ def new_patient():
         conn.rollback()
         flash(f'Error saving patient: {str(e)}', 'error')
         if conn:
-            conn.close()
+            release_db_connection(conn)
         return redirect(url_for('new_patient'))
 
 
@@ -1941,14 +2664,7 @@ def new_patient():
 @staff_or_admin_required
 def validate_data():
     """Search and list patients for validation with optional filtering"""
-    conn = get_db_connection()
-    if not conn:
-        flash('Database connection error', 'error')
-        return render_template('validate_data.html', patients=[])
-
     try:
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-
         # Get search parameters (from GET for search, POST for filters)
         search_type = request.args.get('type', 'id')
         search_query = request.args.get('q', '')
@@ -2025,16 +2741,18 @@ def validate_data():
             # Show 20 most recent patients if no search query or filters
             base_query += 'ORDER BY ps.patient_id DESC LIMIT 20'
 
-        # Execute query
-        if params:
-            cur.execute(base_query, params)
-        else:
-            cur.execute(base_query)
-
-        patients = cur.fetchall()
+        # Execute query (read-only, so in autocommit; the template only reads
+        # attributes, so plain named tuples instead of a dict per row)
+        with db_cursor(NamedTupleCursor) as cur:
+            if cur is None:
+                flash('Database connection error', 'error')
+                return render_template('validate_data.html', patients=[])
+            if params:
+                cur.execute(base_query, params)
+            else:
+                cur.execute(base_query)
 
-        cur.close()
-        conn.close()
+            patients = cur.fetchall()
 
         return render_template('validate_data.html',
                                patients=patients,
@@ -2045,8 +2763,6 @@ def validate_data():
 
     except Exception as e:
         flash(f'Error searching patients: {str(e)}', 'error')
-        if conn:
-            conn.close()
         return render_template('validate_data.html',
                                patients=[],
                                search_type=search_type,
@@ -2067,11 +2783,36 @@ def edit_patient(patient_id):
         try:
             cur = conn.cursor(cursor_factory=RealDictCursor)
 
-            # Get patient data
+            # The patient, its ocular conditions row (NULL if none yet), its repeated
+            # entries and the dropdown lists, all in one round trip; each list comes back
+            # as a JSON array of row objects
             cur.execute('''
-                SELECT ps.*, pst.sex, pst.eye, pst.age
+                SELECT ps.*, pst.sex, pst.eye, pst.age, to_jsonb(oc) AS ocular_conditions,
+                       (SELECT COALESCE(json_agg(c ORDER BY c.id), '[]') FROM other_ocular_conditions c
+                        WHERE c.patient_id = ps.patient_id) AS other_conditions,
+                       (SELECT COALESCE(json_agg(c ORDER BY c.id), '[]') FROM previous_ocular_surgeries c
+                        WHERE c.patient_id = ps.patient_id) AS surgeries,
+                       (SELECT COALESCE(json_agg(c ORDER BY c.id), '[]') FROM systemic_conditions c
+                        WHERE c.patient_id = ps.patient_id) AS systemic,
+                       (SELECT COALESCE(json_agg(c ORDER BY c.id), '[]') FROM ocular_medications c
+                        WHERE c.patient_id = ps.patient_id) AS ocular_meds,
+                       (SELECT COALESCE(json_agg(c ORDER BY c.id), '[]') FROM systemic_medications c
+                        WHERE c.patient_id = ps.patient_id) AS systemic_meds,
+                       (SELECT COALESCE(json_agg(r ORDER BY r.code), '[]') FROM (
+                            SELECT code, description FROM icd10_ocular_conditions WHERE active = TRUE) r
+                       ) AS icd10_ocular,
+                       (SELECT COALESCE(json_agg(r ORDER BY r.code), '[]') FROM (
+                            SELECT code, description FROM icd10_systemic_conditions WHERE active = TRUE) r
+                       ) AS icd10_systemic,
+                       (SELECT COALESCE(json_agg(r ORDER BY r.trade_name), '[]') FROM (
+                            SELECT trade_name, generic_name, medication_type FROM medications WHERE active = TRUE) r
+                       ) AS medications,
+                       (SELECT COALESCE(json_agg(r ORDER BY r.code), '[]') FROM (
+                            SELECT code, description FROM surgeries WHERE active = TRUE) r
+                       ) AS surgeries_list
                 FROM patients_sensitive ps
                 JOIN patients_statistical pst ON ps.patient_id = pst.patient_id
+                LEFT JOIN ocular_conditions oc ON oc.patient_id = ps.patient_id
                 WHERE ps.patient_id = %s
             ''', (patient_id,))
             patient = cur.fetchone()
@@ -2079,49 +2820,16 @@ def edit_patient(patient_id):
             if not patient:
                 flash(f'Patient #{patient_id} not found', 'error')
                 cur.close()
-                conn.close()
+                release_db_connection(conn)
                 return redirect(url_for('validate_data'))
 
-            # Get ocular conditions
-            cur.execute('SELECT * FROM ocular_conditions WHERE patient_id = %s', (patient_id,))
-            ocular_conditions = cur.fetchone()
-
-            # Get other ocular conditions
-            cur.execute('SELECT * FROM other_ocular_conditions WHERE patient_id = %s', (patient_id,))
-            other_ocular = cur.fetchall()
-
-            # Get previous surgeries
-            cur.execute('SELECT * FROM previous_ocular_surgeries WHERE patient_id = %s', (patient_id,))
-            surgeries = cur.fetchall()
-
-            # Get systemic conditions
-            cur.execute('SELECT * FROM systemic_conditions WHERE patient_id = %s', (patient_id,))
-            systemic = cur.fetchall()
-
-            # Get ocular medications
-            cur.execute('SELECT * FROM ocular_medications WHERE patient_id = %s', (patient_id,))
-            ocular_meds = cur.fetchall()
-
-            # Get systemic medications
-            cur.execute('SELECT * FROM systemic_medications WHERE patient_id = %s', (patient_id,))
-            systemic_meds = cur.fetchall()
-
-            # Get reference data for dropdowns
-            cur.execute('SELECT code, description FROM icd10_ocular_conditions WHERE active = TRUE ORDER BY code')
-            icd10_ocular = cur.fetchall()
-
-            cur.execute('SELECT code, description FROM icd10_systemic_conditions WHERE active = TRUE ORDER BY code')
-            icd10_systemic = cur.fetchall()
-
-            cur.execute(
-                'SELECT trade_name, generic_name, medication_type FROM medications WHERE active = TRUE ORDER BY trade_name')
-            medications = cur.fetchall()
-
-            cur.execute('SELECT code, description FROM surgeries WHERE active = TRUE ORDER BY code')
-            surgeries_list = cur.fetchall()
+            ocular_conditions = patient.pop('ocular_conditions')
+            lists = {name: patient.pop(name) for name in (
+                'other_conditions', 'surgeries', 'systemic', 'ocular_meds', 'systemic_meds',
+                'icd10_ocular', 'icd10_systemic', 'medications', 'surgeries_list')}
 
             cur.close()
-            conn.close()
+            release_db_connection(conn)
 
             # Prepare stats with default values (in case template needs them)
             stats = {
@@ -2133,39 +2841,32 @@ def edit_patient(patient_id):
             return render_template('edit_patient.html',
                                    patient=patient,
                                    ocular_conditions=ocular_conditions,
-                                   other_conditions=other_ocular,
-                                   surgeries=surgeries,
-                                   systemic=systemic,
-                                   ocular_meds=ocular_meds,
-                                   systemic_meds=systemic_meds,
-                                   icd10_ocular=icd10_ocular,
-                                   icd10_systemic=icd10_systemic,
-                                   medications=medications,
-                                   surgeries_list=surgeries_list,
-                                   stats=stats)
+                                   stats=stats,
+                                   **lists)
         except Exception as e:
             flash(f'Error loading patient data: {str(e)}', 'error')
             if conn:
-                conn.close()
+                release_db_connection(conn)
             return redirect(url_for('validate_data'))
 
     # POST - Update patient data
     try:
         cur = conn.cursor()
 
-        # Get basic patient data
-        patient_name = request.form.get('patient_name')
-        mbo = request.form.get('mbo')
-        sex = request.form.get('sex')
-        eye = request.form.get('eye')
+        # Get basic patient data (a plain dict for the single-valued fields)
+        form = request.form.to_dict(flat=True)
+        patient_name = form.get('patient_name')
+        mbo = form.get('mbo')
+        sex = form.get('sex')
+        eye = form.get('eye')
 
         # Get date fields
-        dob_day = request.form.get('dob_day')
-        dob_month = request.form.get('dob_month')
-        dob_year = request.form.get('dob_year')
-        dosc_day = request.form.get('collection_day')
-        dosc_month = request.form.get('collection_month')
-        dosc_year = request.form.get('collection_year')
+        dob_day = form.get('dob_day')
+        dob_month = form.get('dob_month')
+        dob_year = form.get('dob_year')
+        dosc_day = form.get('collection_day')
+        dosc_month = form.get('collection_month')
+        dosc_year = form.get('collection_year')
 
         # Parse dates
         date_of_birth = None
@@ -2174,6 +2875,8 @@ def edit_patient(patient_id):
                 date_of_birth = date(int(dob_year), int(dob_month), int(dob_day))
             except ValueError:
                 flash('Invalid date of birth', 'error')
+                cur.close()
+                release_db_connection(conn)
                 return redirect(url_for('edit_patient', patient_id=patient_id))
 
         date_of_sample_collection = None
@@ -2182,182 +2885,36 @@ def edit_patient(patient_id):
                 date_of_sample_collection = date(int(dosc_year), int(dosc_month), int(dosc_day))
             except ValueError:
                 flash('Invalid sample collection date', 'error')
+                cur.close()
+                release_db_connection(conn)
                 return redirect(url_for('edit_patient', patient_id=patient_id))
 
         # Calculate age and person hash
-        age = None
-        if date_of_birth and date_of_sample_collection:
-            age = date_of_sample_collection.year - date_of_birth.year
-            if date_of_sample_collection.month < date_of_birth.month or \
-                    (date_of_sample_collection.month == date_of_birth.month and
-                     date_of_sample_collection.day < date_of_birth.day):
-                age -= 1
+        age = calculate_age(date_of_birth, date_of_sample_collection)
+        person_hash = generate_person_hash(mbo)
 
-        person_hash = hashlib.sha256(mbo.encode()).hexdigest() if mbo else None
+        # Update patients_sensitive, patients_statistical and ocular_conditions
+        # in one prepared statement (the edit form defaults glaucoma to '0')
+        execute_prepared(cur, 'update_patient', (
+            patient_name, mbo, date_of_birth, date_of_sample_collection, patient_id,
+            person_hash, age, sex, eye) + ocular_condition_values(form, glaucoma='0'))
 
-        # Update patients_sensitive table
-        cur.execute('''
-            UPDATE patients_sensitive
-            SET patient_name = %s, mbo = %s, date_of_birth = %s, 
-                date_of_sample_collection = %s, updated_at = CURRENT_TIMESTAMP
-            WHERE patient_id = %s
-        ''', (patient_name, mbo, date_of_birth, date_of_sample_collection, patient_id))
-
-        # Update patients_statistical table
-        cur.execute('''
-            UPDATE patients_statistical
-            SET person_hash = %s, age = %s, sex = %s, eye = %s
-            WHERE patient_id = %s
-        ''', (person_hash, age, sex, eye, patient_id))
-
-        # Get all ocular condition fields
-        lens_status = request.form.get('lens_status', 'ND')
-        locs_iii_no = request.form.get('locs_no', 'ND')
-        locs_iii_nc = request.form.get('locs_nc', 'ND')
-        locs_iii_c = request.form.get('locs_c', 'ND')
-        locs_iii_p = request.form.get('locs_p', 'ND')
-        iol_type = request.form.get('iol_type', 'ND')
-        etiology_aphakia = request.form.get('aphakia_etiology', 'ND')
-        glaucoma = request.form.get('glaucoma', '0')
-        oht_or_pac = request.form.get('oht_or_pac', 'ND')
-        etiology_glaucoma = request.form.get('glaucoma_etiology', 'ND')
-        steroid_responder = request.form.get('steroid_responder', 'ND')
-        pxs = request.form.get('pxs', '0')
-        pds = request.form.get('pds', '0')
-        diabetic_retinopathy = request.form.get('diabetic_retinopathy', '0')
-        stage_diabetic_retinopathy = request.form.get('dr_stage', 'ND')
-        stage_npdr = request.form.get('npdr_stage', 'ND')
-        stage_pdr = request.form.get('pdr_stage', 'ND')
-        macular_edema = request.form.get('macular_edema', '0')
-        etiology_macular_edema = request.form.get('me_etiology', 'ND')
-        macular_degeneration_dystrophy = request.form.get('macular_degeneration', '0')
-        etiology_macular_deg_dyst = request.form.get('md_etiology', 'ND')
-        stage_amd = request.form.get('amd_stage', 'ND')
-        exudation_amd = request.form.get('amd_exudation', 'ND')
-        stage_other_macular_deg = request.form.get('other_md_stage', 'ND')
-        exudation_other_macular_deg = request.form.get('other_md_exudation', 'ND')
-        macular_hole_vmt = request.form.get('mh_vmt', '0')
-        etiology_mh_vmt = request.form.get('mh_vmt_etiology', 'ND')
-        cause_secondary_mh_vmt = request.form.get('secondary_mh_vmt_cause', 'ND')
-        treatment_status_mh_vmt = request.form.get('mh_vmt_treatment_status', 'ND')
-        epiretinal_membrane = request.form.get('epiretinal_membrane', '0')
-        etiology_erm = request.form.get('erm_etiology', 'ND')
-        cause_secondary_erm = request.form.get('secondary_erm_cause', 'ND')
-        treatment_status_erm = request.form.get('erm_treatment_status', 'ND')
-        retinal_detachment = request.form.get('retinal_detachment', '0')
-        etiology_rd = request.form.get('rd_etiology', 'ND')
-        treatment_status_rd = request.form.get('rd_treatment_status', 'ND')
-        pvr = request.form.get('pvr', 'ND')
-        vitreous_haemorrhage_opacification = request.form.get('vitreous_opacification', '0')
-        etiology_vitreous_haemorrhage = request.form.get('vh_etiology', 'ND')
-
-        # Update ocular_conditions table
+        # Delete existing many-to-many relationships and re-insert
+        # (all five deletes go to the server in one round trip)
         cur.execute('''
-            UPDATE ocular_conditions
-            SET lens_status = %s, locs_iii_no = %s, locs_iii_nc = %s, locs_iii_c = %s, locs_iii_p = %s,
-                iol_type = %s, etiology_aphakia = %s, glaucoma = %s, oht_or_pac = %s, etiology_glaucoma = %s,
-                steroid_responder = %s, pxs = %s, pds = %s, diabetic_retinopathy = %s,
-                stage_diabetic_retinopathy = %s, stage_npdr = %s, stage_pdr = %s, macular_edema = %s,
-                etiology_macular_edema = %s, macular_degeneration_dystrophy = %s,
-                etiology_macular_deg_dyst = %s, stage_amd = %s, exudation_amd = %s,
-                stage_other_macular_deg = %s, exudation_other_macular_deg = %s, macular_hole_vmt = %s,
-                etiology_mh_vmt = %s, cause_secondary_mh_vmt = %s, treatment_status_mh_vmt = %s,
-                epiretinal_membrane = %s, etiology_erm = %s, cause_secondary_erm = %s,
-                treatment_status_erm = %s, retinal_detachment = %s, etiology_rd = %s,
-                treatment_status_rd = %s, pvr = %s, vitreous_haemorrhage_opacification = %s,
-                etiology_vitreous_haemorrhage = %s, updated_at = CURRENT_TIMESTAMP
-            WHERE patient_id = %s
-        ''', (lens_status, locs_iii_no, locs_iii_nc, locs_iii_c, locs_iii_p,
-              iol_type, etiology_aphakia, glaucoma, oht_or_pac, etiology_glaucoma,
-              steroid_responder, pxs, pds, diabetic_retinopathy, stage_diabetic_retinopathy,
-              stage_npdr, stage_pdr, macular_edema, etiology_macular_edema,
-              macular_degeneration_dystrophy, etiology_macular_deg_dyst, stage_amd, exudation_amd,
-              stage_other_macular_deg, exudation_other_macular_deg, macular_hole_vmt, etiology_mh_vmt,
-              cause_secondary_mh_vmt, treatment_status_mh_vmt, epiretinal_membrane, etiology_erm,
-              cause_secondary_erm, treatment_status_erm, retinal_detachment, etiology_rd,
-              treatment_status_rd, pvr, vitreous_haemorrhage_opacification, etiology_vitreous_haemorrhage,
-              patient_id))
+            DELETE FROM other_ocular_conditions WHERE patient_id = %(patient_id)s;
+            DELETE FROM previous_ocular_surgeries WHERE patient_id = %(patient_id)s;
+            DELETE FROM systemic_conditions WHERE patient_id = %(patient_id)s;
+            DELETE FROM ocular_medications WHERE patient_id = %(patient_id)s;
+            DELETE FROM systemic_medications WHERE patient_id = %(patient_id)s;
+        ''', {'patient_id': patient_id})
 
-        # Delete existing many-to-many relationships and re-insert
-        cur.execute('DELETE FROM other_ocular_conditions WHERE patient_id = %s', (patient_id,))
-        cur.execute('DELETE FROM previous_ocular_surgeries WHERE patient_id = %s', (patient_id,))
-        cur.execute('DELETE FROM systemic_conditions WHERE patient_id = %s', (patient_id,))
-        cur.execute('DELETE FROM ocular_medications WHERE patient_id = %s', (patient_id,))
-        cur.execute('DELETE FROM systemic_medications WHERE patient_id = %s', (patient_id,))
-
-        # Other Ocular Conditions (multiple entries possible)
-        other_ocular_conditions = request.form.getlist('other_ocular_condition[]')
-        other_ocular_eyes = request.form.getlist('other_ocular_condition_eye[]')
-        for icd10_code, eye_affected in zip(other_ocular_conditions, other_ocular_eyes):
-            if icd10_code and icd10_code not in ['0', 'ND']:
-                cur.execute('''
-                    INSERT INTO other_ocular_conditions (patient_id, icd10_code, eye)
-                    VALUES (%s, %s, %s)
-                ''', (patient_id, icd10_code, eye_affected))
-
-        # Previous Ocular Surgeries (multiple entries possible)
-        surgeries_list = request.form.getlist('previous_surgery[]')
-        surgeries_eyes = request.form.getlist('previous_surgery_eye[]')
-        for surgery_code, eye_affected in zip(surgeries_list, surgeries_eyes):
-            if surgery_code and surgery_code not in ['0', 'ND']:
-                cur.execute('''
-                    INSERT INTO previous_ocular_surgeries (patient_id, surgery_code, eye)
-                    VALUES (%s, %s, %s)
-                ''', (patient_id, surgery_code, eye_affected))
-
-        # Systemic Conditions (multiple entries possible)
-        systemic_conditions_list = request.form.getlist('systemic_condition[]')
-        for icd10_code in systemic_conditions_list:
-            if icd10_code and icd10_code not in ['0', 'ND']:
-                cur.execute('''
-                    INSERT INTO systemic_conditions (patient_id, icd10_code)
-                    VALUES (%s, %s)
-                ''', (patient_id, icd10_code))
-
-        # Ocular Medications (multiple entries possible)
-        ocular_meds_list = request.form.getlist('ocular_medication[]')
-        ocular_meds_eyes = request.form.getlist('ocular_medication_eye[]')
-        ocular_meds_days = request.form.getlist('ocular_medication_days[]')
-
-        for medication, eye_affected, last_app in zip(ocular_meds_list, ocular_meds_eyes, ocular_meds_days):
-            if medication and medication not in ['0', 'ND']:
-                # Split medication into trade_name|generic_name
-                parts = medication.split('|')
-                if len(parts) == 2:
-                    trade_name, generic_name = parts
-                    # Default to 0 if blank or invalid
-                    if last_app and last_app.strip() and last_app.isdigit():
-                        last_application_days = int(last_app)
-                    else:
-                        last_application_days = 0  # Default to 0
-                    cur.execute('''
-                        INSERT INTO ocular_medications (patient_id, trade_name, generic_name, eye, last_application_days)
-                        VALUES (%s, %s, %s, %s, %s)
-                    ''', (patient_id, trade_name, generic_name, eye_affected, last_application_days))
-
-        # Systemic Medications (multiple entries possible)
-        systemic_meds_list = request.form.getlist('systemic_medication[]')
-        systemic_meds_days = request.form.getlist('systemic_medication_days[]')
-
-        for medication, last_app in zip(systemic_meds_list, systemic_meds_days):
-            if medication and medication not in ['0', 'ND']:
-                # Split medication into trade_name|generic_name
-                parts = medication.split('|')
-                if len(parts) == 2:
-                    trade_name, generic_name = parts
-                    # Default to 0 if blank or invalid
-                    if last_app and last_app.strip() and last_app.isdigit():
-                        last_application_days = int(last_app)
-                    else:
-                        last_application_days = 0  # Default to 0
-                    cur.execute('''
-                        INSERT INTO systemic_medications (patient_id, trade_name, generic_name, last_application_days)
-                        VALUES (%s, %s, %s, %s)
-                    ''', (patient_id, trade_name, generic_name, last_application_days))
+        # Other conditions, surgeries and medications, one round trip per table
+        insert_patient_entries(cur, patient_id, request.form)
 
         conn.commit()
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
         flash(f'Patient #{patient_id:05d} - {patient_name} has been updated successfully!', 'success')
         return redirect(url_for('validate_data'))
@@ -2366,7 +2923,7 @@ def edit_patient(patient_id):
         conn.rollback()
         flash(f'Error updating patient: {str(e)}', 'error')
         if conn:
-            conn.close()
+            release_db_connection(conn)
         return redirect(url_for('edit_patient', patient_id=patient_id))
 
 
@@ -2380,47 +2937,172 @@ def delete_patient(patient_id):
         return redirect(url_for('validate_data'))
 
     try:
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-
-        # Get patient name for confirmation message
-        cur.execute('SELECT patient_name FROM patients_sensitive WHERE patient_id = %s', (patient_id,))
-        patient = cur.fetchone()
+        cur = conn.cursor()
+
+        # Delete patient (CASCADE will handle related records)
+        # This will delete from:
+        # - patients_sensitive (main table)
+        # - patients_statistical (CASCADE)
+        # - ocular_conditions (CASCADE)
+        # - other_ocular_conditions (CASCADE)
+        # - previous_ocular_surgeries (CASCADE)
+        # - systemic_conditions (CASCADE)
+        # - ocular_medications (CASCADE)
+        # - systemic_medications (CASCADE)
+        # The patient's name comes back for the confirmation message
+        cur.execute('DELETE FROM patients_sensitive WHERE patient_id = %s RETURNING patient_name', (patient_id,))
+        deleted = cur.fetchone()
+
+        conn.commit()
+        cur.close()
+        release_db_connection(conn)
+
+        if not deleted:
+            flash(f'Patient #{patient_id} not found', 'error')
+            return redirect(url_for('validate_data'))
+
+        forget_dashboard_stats()
+        patient_name, = deleted
+        flash(
+            f'Patient #{patient_id:05d} - {patient_name} has been permanently deleted. The ID is now available for reuse.',
+            'success')
+        return redirect(url_for('validate_data'))
+
+    except Exception as e:
+        if conn:
+            conn.rollback()
+            release_db_connection(conn)
+        flash(f'Error deleting patient: {str(e)}', 'error')
+        return redirect(url_for('validate_data'))
+
+
+# Header names expected in a bulk patient file (matched ignoring case and surrounding whitespace)
+PATIENT_IMPORT_COLUMNS = ('patient_id', 'patient_name', 'mbo', 'date_of_birth', 'date_of_sample_collection',
+                          'sex', 'eye')
+PATIENT_IMPORT_REQUIRED_COLUMNS = ('patient_id', 'patient_name', 'mbo')
+
+
+@app.route('/api/patients-bulk-import', methods=['POST'])
+@admin_required
+def patients_bulk_import():
+    """
+    Import general patient data (one row per patient) from CSV/Excel
+
+    Ocular conditions are created with their form defaults, to be filled in
+    from the edit page. Rows whose patient ID is already taken are skipped.
+    """
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file provided'}), 400
+
+    file = request.files['file']
+    filename = file.filename.lower()
+    if not any(filename.endswith(ext) for ext in ['.csv', '.xls', '.xlsx']):
+        return jsonify({'error': 'Invalid file format. Please upload CSV, XLS, or XLSX'}), 400
+
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({'error': 'Database connection error'}), 500
+
+    try:
+        df = read_upload_dataframe(file, filename)
+        df.columns = df.columns.str.strip().str.lower()
+
+        missing = [column for column in PATIENT_IMPORT_REQUIRED_COLUMNS if column not in df.columns]
+        if missing:
+            release_db_connection(conn)
+            return jsonify({'error': f'Missing required columns: {", ".join(missing)}'}), 400
+        # Optional columns left out of the file come back empty; object dtype keeps
+        # the .str accessor working on them (all-NaN columns would be float64)
+        df = df.reindex(columns=PATIENT_IMPORT_COLUMNS).astype(object)
+
+        # Clean and validate whole columns at once rather than row by row
+        patient_ids = pd.to_numeric(df['patient_id'], errors='coerce')
+        patient_names = df['patient_name'].str.strip()
+        mbos = df['mbo'].str.strip()
+        dates_of_birth = pd.to_datetime(df['date_of_birth'], errors='coerce', format='mixed', dayfirst=True)
+        dates_of_sample = pd.to_datetime(df['date_of_sample_collection'], errors='coerce', format='mixed',
+                                         dayfirst=True)
+        sexes = df['sex'].str.strip().str.upper()
+        eyes = df['eye'].str.strip().str.upper()
+
+        valid = (patient_ids.between(1, 99999) & (patient_ids % 1 == 0)
+                 & (patient_names.str.len() > 0) & mbos.str.len().between(1, 9))
+        stage = pd.DataFrame({
+            'patient_id': patient_ids,
+            'patient_name': patient_names,
+            'mbo': mbos,
+            'date_of_birth': dates_of_birth.dt.date,
+            'date_of_sample_collection': dates_of_sample.dt.date,
+            'sex': sexes.where(sexes.isin(['M', 'F'])),
+            'eye': eyes.where(eyes.isin(['L', 'R']), 'ND')
+        })[valid]
+        stage['patient_id'] = stage['patient_id'].astype(int)
+
+        # Ages from the parsed datetime64 columns, not the date objects staged for COPY
+        stage['person_hash'], ages = bulk_hash_and_age(stage['mbo'], dates_of_birth[valid],
+                                                       dates_of_sample[valid])
+        stage['age'] = ages.set_axis(stage.index)
 
-        if not patient:
-            flash(f'Patient #{patient_id} not found', 'error')
-            cur.close()
-            conn.close()
-            return redirect(url_for('validate_data'))
+        cur = conn.cursor()
+        # Stream the rows into a staging table with COPY (the index becomes row_num)
+        buffer = io.StringIO()
+        stage.to_csv(buffer, header=False)
+        buffer.seek(0)
 
-        patient_name = patient['patient_name']
+        cur.execute('''
+            CREATE TEMP TABLE patients_import_stage (
+                row_num INTEGER,
+                patient_id INTEGER,
+                patient_name TEXT,
+                mbo TEXT,
+                date_of_birth DATE,
+                date_of_sample_collection DATE,
+                sex TEXT,
+                eye TEXT,
+                person_hash TEXT,
+                age INTEGER
+            ) ON COMMIT DROP
+        ''')
+        cur.copy_expert('COPY patients_import_stage FROM STDIN WITH (FORMAT csv)', buffer)
 
-        # Delete patient (CASCADE will handle related records)
-        # This will delete from:
-        # - patients_sensitive (main table)
-        # - patients_statistical (CASCADE)
-        # - ocular_conditions (CASCADE)
-        # - other_ocular_conditions (CASCADE)
-        # - previous_ocular_surgeries (CASCADE)
-        # - systemic_conditions (CASCADE)
-        # - ocular_medications (CASCADE)
-        # - systemic_medications (CASCADE)
-        cur.execute('DELETE FROM patients_sensitive WHERE patient_id = %s', (patient_id,))
+        # One statement for all three tables; a patient ID repeated in the file keeps
+        # its first row, and IDs already in the database are left alone
+        cur.execute('''
+            WITH incoming AS (
+                SELECT DISTINCT ON (patient_id) *
+                FROM patients_import_stage
+                ORDER BY patient_id, row_num
+            ), ins_sensitive AS (
+                INSERT INTO patients_sensitive (patient_id, patient_name, mbo, date_of_birth, date_of_sample_collection)
+                SELECT patient_id, patient_name, mbo, date_of_birth, date_of_sample_collection FROM incoming
+                ON CONFLICT (patient_id) DO NOTHING
+                RETURNING patient_id
+            ), ins_statistical AS (
+                INSERT INTO patients_statistical (patient_id, person_hash, age, sex, eye)
+                SELECT patient_id, person_hash, age, sex, eye FROM incoming JOIN ins_sensitive USING (patient_id)
+            )
+            INSERT INTO ocular_conditions (patient_id, {columns})
+            SELECT patient_id, {placeholders} FROM ins_sensitive
+        '''.format(columns=OCULAR_CONDITION_COLUMNS, placeholders=', '.join(['%s'] * len(OCULAR_CONDITION_FIELDS))),
+            tuple(OCULAR_CONDITION_DEFAULTS.values()))
+        imported = cur.rowcount
 
         conn.commit()
         cur.close()
-        conn.close()
+        release_db_connection(conn)
+        forget_dashboard_stats()
 
-        flash(
-            f'Patient #{patient_id:05d} - {patient_name} has been permanently deleted. The ID is now available for reuse.',
-            'success')
-        return redirect(url_for('validate_data'))
+        return jsonify({
+            'success': True,
+            'imported': imported,
+            'skipped': len(df) - imported
+        })
 
     except Exception as e:
         if conn:
             conn.rollback()
-            conn.close()
-        flash(f'Error deleting patient: {str(e)}', 'error')
-        return redirect(url_for('validate_data'))
+            release_db_connection(conn)
+        return jsonify({'error': f'Import failed: {str(e)}'}), 500
 
 
 # Export Data Route
@@ -2486,7 +3168,7 @@ def export_data():
             data_type = request.form.get('data_type', 'anonymized')
 
             # Staff can only export anonymized data
-            if session.get('role') == 'Staff':
+            if g.user.role == 'Staff':
                 data_type = 'anonymized'
 
             # Get date range if provided
@@ -2504,8 +3186,11 @@ def export_data():
             # STEP 1: Query all reference data (including inactive items used by any patient)
             # ============================================================
 
+            # Plain tuple cursor for the bulk lookups below - no per-row dict needed
+            tuple_cur = conn.cursor()
+
             # Get all medications (active OR used by patients)
-            cur.execute('''
+            tuple_cur.execute('''
                 SELECT DISTINCT generic_name
                 FROM (
                     SELECT generic_name FROM medications WHERE active = TRUE
@@ -2516,7 +3201,7 @@ def export_data():
                 ) AS all_meds
                 ORDER BY generic_name
             ''')
-            all_medications = [row['generic_name'] for row in cur.fetchall()]
+            all_medications = [generic_name for (generic_name,) in tuple_cur]
 
             # Get all unique generic components for dynamic columns
             all_generic_components = get_all_generic_components()
@@ -2525,7 +3210,7 @@ def export_data():
             sorted_generic_components = sorted(all_generic_components)
 
             # Get all ocular ICD-10 codes (active OR used by patients)
-            cur.execute('''
+            tuple_cur.execute('''
                 SELECT DISTINCT code
                 FROM (
                     SELECT code FROM icd10_ocular_conditions WHERE active = TRUE
@@ -2534,10 +3219,10 @@ def export_data():
                 ) AS all_codes
                 ORDER BY code
             ''')
-            all_ocular_codes = [row['code'] for row in cur.fetchall()]
+            all_ocular_codes = [code for (code,) in tuple_cur]
 
             # Get all systemic ICD-10 codes (active OR used by patients)
-            cur.execute('''
+            tuple_cur.execute('''
                 SELECT DISTINCT code
                 FROM (
                     SELECT code FROM icd10_systemic_conditions WHERE active = TRUE
@@ -2546,11 +3231,11 @@ def export_data():
                 ) AS all_codes
                 ORDER BY code
             ''')
-            all_systemic_codes = [row['code'] for row in cur.fetchall()]
+            all_systemic_codes = [code for (code,) in tuple_cur]
 
             # Get all surgery codes (active OR used by patients)
             # FIXED: surgeries table uses 'code' not 'surgery_code'
-            cur.execute('''
+            tuple_cur.execute('''
                 SELECT DISTINCT code
                 FROM (
                     SELECT code FROM surgeries WHERE active = TRUE
@@ -2559,13 +3244,13 @@ def export_data():
                 ) AS all_surgeries
                 ORDER BY code
             ''')
-            all_surgeries = [row['code'] for row in cur.fetchall()]
+            all_surgeries = [code for (code,) in tuple_cur]
 
             # ============================================================
             # STEP 2: Build base query for patients
             # ============================================================
 
-            if data_type == 'sensitive' and session.get('role') == 'Administrator':
+            if data_type == 'sensitive' and g.user.role == 'Administrator':
                 # Sensitive export - includes names and MBO
                 base_query = '''
                     SELECT 
@@ -2673,67 +3358,57 @@ def export_data():
             # Preload other ocular conditions
             patient_ocular_conditions = {}
             if include_other_conditions and patient_ids:
-                cur.execute('''
+                tuple_cur.execute('''
                     SELECT patient_id, icd10_code, eye 
                     FROM other_ocular_conditions 
                     WHERE patient_id = ANY(%s)
                 ''', (patient_ids,))
-                for row in cur.fetchall():
-                    if row['patient_id'] not in patient_ocular_conditions:
-                        patient_ocular_conditions[row['patient_id']] = []
-                    patient_ocular_conditions[row['patient_id']].append(row)
+                for patient_id, icd10_code, eye in tuple_cur:
+                    patient_ocular_conditions.setdefault(patient_id, []).append((icd10_code, eye))
 
             # Preload surgeries
             patient_surgeries = {}
             if include_surgeries and patient_ids:
-                cur.execute('''
+                tuple_cur.execute('''
                     SELECT patient_id, surgery_code, eye 
                     FROM previous_ocular_surgeries 
                     WHERE patient_id = ANY(%s)
                 ''', (patient_ids,))
-                for row in cur.fetchall():
-                    if row['patient_id'] not in patient_surgeries:
-                        patient_surgeries[row['patient_id']] = []
-                    patient_surgeries[row['patient_id']].append(row)
+                for patient_id, surgery_code, eye in tuple_cur:
+                    patient_surgeries.setdefault(patient_id, []).append((surgery_code, eye))
 
             # Preload systemic conditions
             patient_systemic = {}
             if include_systemic and patient_ids:
-                cur.execute('''
+                tuple_cur.execute('''
                     SELECT patient_id, icd10_code 
                     FROM systemic_conditions 
                     WHERE patient_id = ANY(%s)
                 ''', (patient_ids,))
-                for row in cur.fetchall():
-                    if row['patient_id'] not in patient_systemic:
-                        patient_systemic[row['patient_id']] = []
-                    patient_systemic[row['patient_id']].append(row)
+                for patient_id, icd10_code in tuple_cur:
+                    patient_systemic.setdefault(patient_id, []).append(icd10_code)
 
             # Preload ocular medications
             patient_ocular_meds = {}
             if include_medications and patient_ids:
-                cur.execute('''
+                tuple_cur.execute('''
                     SELECT patient_id, generic_name, eye, last_application_days 
                     FROM ocular_medications 
                     WHERE patient_id = ANY(%s)
                 ''', (patient_ids,))
-                for row in cur.fetchall():
-                    if row['patient_id'] not in patient_ocular_meds:
-                        patient_ocular_meds[row['patient_id']] = []
-                    patient_ocular_meds[row['patient_id']].append(row)
+                for patient_id, generic_name, eye, last_application_days in tuple_cur:
+                    patient_ocular_meds.setdefault(patient_id, []).append((generic_name, eye, last_application_days))
 
             # Preload systemic medications
             patient_systemic_meds = {}
             if include_medications and patient_ids:
-                cur.execute('''
+                tuple_cur.execute('''
                     SELECT patient_id, generic_name, last_application_days 
                     FROM systemic_medications 
                     WHERE patient_id = ANY(%s)
                 ''', (patient_ids,))
-                for row in cur.fetchall():
-                    if row['patient_id'] not in patient_systemic_meds:
-                        patient_systemic_meds[row['patient_id']] = []
-                    patient_systemic_meds[row['patient_id']].append(row)
+                for patient_id, generic_name, last_application_days in tuple_cur:
+                    patient_systemic_meds.setdefault(patient_id, []).append((generic_name, last_application_days))
 
             # ============================================================
             # STEP 4: Build column headers (BINARY FORMAT)
@@ -2757,7 +3432,7 @@ def export_data():
                 return safe
 
             # Start with base columns
-            if data_type == 'sensitive' and session.get('role') == 'Administrator':
+            if data_type == 'sensitive' and g.user.role == 'Administrator':
                 final_columns = [
                     'patient_id', 'patient_name', 'mbo', 'sex', 'date_of_birth',
                     'date_of_sample_collection', 'eye', 'person_hash', 'age'
@@ -2858,38 +3533,38 @@ def export_data():
 
                 # Fill other ocular conditions (BINARY)
                 if include_other_conditions:
-                    for cond in patient_ocular_conditions.get(patient['patient_id'], []):
-                        safe_code = make_safe_column_name(cond['icd10_code'])
+                    for icd10_code, eye in patient_ocular_conditions.get(patient['patient_id'], []):
+                        safe_code = make_safe_column_name(icd10_code)
                         row[f'other_ocular_{safe_code}'] = 1
-                        row[f'other_ocular_{safe_code}_eye'] = cond['eye']
+                        row[f'other_ocular_{safe_code}_eye'] = eye
 
                 # Fill surgeries (BINARY)
                 if include_surgeries:
-                    for surgery in patient_surgeries.get(patient['patient_id'], []):
-                        safe_surgery = make_safe_column_name(surgery['surgery_code'])
+                    for surgery_code, eye in patient_surgeries.get(patient['patient_id'], []):
+                        safe_surgery = make_safe_column_name(surgery_code)
                         row[f'surgery_{safe_surgery}'] = 1
-                        row[f'surgery_{safe_surgery}_eye'] = surgery['eye']
+                        row[f'surgery_{safe_surgery}_eye'] = eye
 
                 # Fill systemic conditions (BINARY)
                 if include_systemic:
-                    for cond in patient_systemic.get(patient['patient_id'], []):
-                        safe_code = make_safe_column_name(cond['icd10_code'])
+                    for icd10_code in patient_systemic.get(patient['patient_id'], []):
+                        safe_code = make_safe_column_name(icd10_code)
                         row[f'systemic_{safe_code}'] = 1
 
                 # Fill ocular medications (BINARY)
                 if include_medications:
-                    for med in patient_ocular_meds.get(patient['patient_id'], []):
-                        safe_med = make_safe_column_name(med['generic_name'])
+                    for generic_name, eye, last_application_days in patient_ocular_meds.get(patient['patient_id'], []):
+                        safe_med = make_safe_column_name(generic_name)
                         row[f'ocular_med_{safe_med}'] = 1
-                        row[f'ocular_med_{safe_med}_eye'] = med['eye']
-                        row[f'ocular_med_{safe_med}_days'] = med['last_application_days']
+                        row[f'ocular_med_{safe_med}_eye'] = eye
+                        row[f'ocular_med_{safe_med}_days'] = last_application_days
 
                 # Fill systemic medications (BINARY)
                 if include_medications:
-                    for med in patient_systemic_meds.get(patient['patient_id'], []):
-                        safe_med = make_safe_column_name(med['generic_name'])
+                    for generic_name, last_application_days in patient_systemic_meds.get(patient['patient_id'], []):
+                        safe_med = make_safe_column_name(generic_name)
                         row[f'systemic_med_{safe_med}'] = 1
-                        row[f'systemic_med_{safe_med}_days'] = med['last_application_days']
+                        row[f'systemic_med_{safe_med}_days'] = last_application_days
 
                 # Extract and fill generic components
                 if include_medications:
@@ -2899,13 +3574,13 @@ def export_data():
                     # Add ocular medications
                     for med in patient_ocular_meds.get(patient['patient_id'], []):
                         patient_all_meds.append({
-                            'generic_name': med['generic_name']
+                            'generic_name': med[0]
                         })
 
                     # Add systemic medications
                     for med in patient_systemic_meds.get(patient['patient_id'], []):
                         patient_all_meds.append({
-                            'generic_name': med['generic_name']
+                            'generic_name': med[0]
                         })
 
                     # Extract generic components dynamically
@@ -2918,6 +3593,11 @@ def export_data():
 
                 export_data.append(row)
 
+            # All data is in memory now - hand the connection back before building the file
+            tuple_cur.close()
+            cur.close()
+            release_db_connection(conn)
+
             # ============================================================
             # STEP 6: Generate export file
             # ============================================================
@@ -2930,7 +3610,6 @@ def export_data():
                     writer.writeheader()
                     writer.writerows(export_data)
 
-                from flask import Response
                 filename_type = 'sensitive' if data_type == 'sensitive' else 'anonymized'
                 return Response(
                     output.getvalue(),
@@ -2941,64 +3620,55 @@ def export_data():
                 )
 
             elif export_format == 'excel':
-                # Generate Excel file
-                try:
-                    from openpyxl import Workbook
-                    from openpyxl.styles import Font, PatternFill, Alignment
-                    from openpyxl.utils import get_column_letter
-
-                    wb = Workbook()
-                    ws = wb.active
-                    ws.title = "Patient Data"
-
-                    if export_data:
-                        # Write headers
-                        header_fill = PatternFill(start_color="3498db", end_color="3498db", fill_type="solid")
-                        header_font = Font(bold=True, color="FFFFFF")
-
-                        for col_idx, fieldname in enumerate(final_columns, 1):
-                            cell = ws.cell(row=1, column=col_idx, value=fieldname)
-                            cell.fill = header_fill
-                            cell.font = header_font
-                            cell.alignment = Alignment(horizontal='center')
-
-                        # Write data
-                        for row_idx, data_row in enumerate(export_data, 2):
-                            for col_idx, fieldname in enumerate(final_columns, 1):
-                                value = data_row.get(fieldname, '')
-                                ws.cell(row=row_idx, column=col_idx, value=value)
-
-                        # Auto-adjust column widths
-                        for col_idx in range(1, len(final_columns) + 1):
-                            ws.column_dimensions[get_column_letter(col_idx)].width = 15
-
-                    # Save to BytesIO
-                    excel_output = io.BytesIO()
-                    wb.save(excel_output)
-                    excel_output.seek(0)
-
-                    from flask import Response
-                    filename_type = 'sensitive' if data_type == 'sensitive' else 'anonymized'
-                    return Response(
-                        excel_output.getvalue(),
-                        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-                        headers={
-                            'Content-Disposition': f'attachment; filename=raman_export_binary_{filename_type}_{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
-                        }
-                    )
-
-                except ImportError:
-                    flash('Excel export requires openpyxl. Please run: pip install openpyxl', 'error')
-                    return redirect(url_for('export_data'))
+                # Generate Excel file (write-only: rows are streamed out instead of
+                # keeping a cell object per value in memory)
+                wb = Workbook(write_only=True)
+                ws = wb.create_sheet("Patient Data")
+
+                if export_data:
+                    # Column widths must be set before any row is written
+                    for col_idx in range(1, len(final_columns) + 1):
+                        ws.column_dimensions[get_column_letter(col_idx)].width = 15
+
+                    # Write headers
+                    header_fill = PatternFill(start_color="3498db", end_color="3498db", fill_type="solid")
+                    header_font = Font(bold=True, color="FFFFFF")
+
+                    header_row = []
+                    for fieldname in final_columns:
+                        cell = WriteOnlyCell(ws, value=fieldname)
+                        cell.fill = header_fill
+                        cell.font = header_font
+                        cell.alignment = Alignment(horizontal='center')
+                        header_row.append(cell)
+                    ws.append(header_row)
+
+                    # Write data
+                    for data_row in export_data:
+                        ws.append([data_row.get(fieldname, '') for fieldname in final_columns])
+
+                # Save to a temporary file and stream it from disk
+                excel_output = tempfile.TemporaryFile(suffix='.xlsx')
+                wb.save(excel_output)
+                excel_output.seek(0)
+
+                filename_type = 'sensitive' if data_type == 'sensitive' else 'anonymized'
+                return send_file(
+                    excel_output,
+                    mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+                    as_attachment=True,
+                    download_name=f'raman_export_binary_{filename_type}_{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx',
+                    max_age=0
+                )
 
         cur.close()
-        conn.close()
+        release_db_connection(conn)
         return render_template('export_data.html', stats=stats)
 
     except Exception as e:
         flash(f'Error with export: {str(e)}', 'error')
         if conn:
-            conn.close()
+            release_db_connection(conn)
         # Return proper stats structure even on error
         return render_template('export_data.html',
                                stats={'total_patients': 0, 'gender': {'M': 0, 'F': 0}, 'age_distribution': []})
@@ -3039,13 +3709,13 @@ def settings():
         }
 
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
         return render_template('settings.html', stats=stats)
     except Exception as e:
         flash(f'Error loading settings: {str(e)}', 'error')
         if conn:
-            conn.close()
+            release_db_connection(conn)
         return render_template('settings.html', stats={})
 
 
@@ -3053,22 +3723,16 @@ def settings():
 @admin_required
 def settings_icd10_ocular():
     """Manage ICD-10 ocular conditions"""
-    conn = get_db_connection()
-    if not conn:
-        flash('Database connection error', 'error')
-        return redirect(url_for('settings'))
-
     try:
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute('SELECT * FROM icd10_ocular_conditions ORDER BY code')
-        codes = cur.fetchall()
-        cur.close()
-        conn.close()
+        with db_cursor() as cur:
+            if cur is None:
+                flash('Database connection error', 'error')
+                return redirect(url_for('settings'))
+            cur.execute('SELECT * FROM icd10_ocular_conditions ORDER BY code')
+            codes = cur.fetchall()
         return render_template('settings_icd10_ocular.html', codes=codes)
     except Exception as e:
         flash(f'Error loading ICD-10 codes: {str(e)}', 'error')
-        if conn:
-            conn.close()
         return redirect(url_for('settings'))
 
 
@@ -3076,22 +3740,16 @@ def settings_icd10_ocular():
 @admin_required
 def settings_icd10_systemic():
     """Manage ICD-10 systemic conditions"""
-    conn = get_db_connection()
-    if not conn:
-        flash('Database connection error', 'error')
-        return redirect(url_for('settings'))
-
     try:
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute('SELECT * FROM icd10_systemic_conditions ORDER BY code')
-        codes = cur.fetchall()
-        cur.close()
-        conn.close()
+        with db_cursor() as cur:
+            if cur is None:
+                flash('Database connection error', 'error')
+                return redirect(url_for('settings'))
+            cur.execute('SELECT * FROM icd10_systemic_conditions ORDER BY code')
+            codes = cur.fetchall()
         return render_template('settings_icd10_systemic.html', codes=codes)
     except Exception as e:
         flash(f'Error loading ICD-10 codes: {str(e)}', 'error')
-        if conn:
-            conn.close()
         return redirect(url_for('settings'))
 
 
@@ -3099,22 +3757,16 @@ def settings_icd10_systemic():
 @admin_required
 def settings_medications():
     """Manage medications"""
-    conn = get_db_connection()
-    if not conn:
-        flash('Database connection error', 'error')
-        return redirect(url_for('settings'))
-
     try:
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute('SELECT * FROM medications ORDER BY trade_name')
-        medications = cur.fetchall()
-        cur.close()
-        conn.close()
+        with db_cursor() as cur:
+            if cur is None:
+                flash('Database connection error', 'error')
+                return redirect(url_for('settings'))
+            cur.execute('SELECT * FROM medications ORDER BY trade_name')
+            medications = cur.fetchall()
         return render_template('settings_medications.html', medications=medications)
     except Exception as e:
         flash(f'Error loading medications: {str(e)}', 'error')
-        if conn:
-            conn.close()
         return redirect(url_for('settings'))
 
 
@@ -3122,22 +3774,16 @@ def settings_medications():
 @admin_required
 def settings_surgeries():
     """Manage surgeries"""
-    conn = get_db_connection()
-    if not conn:
-        flash('Database connection error', 'error')
-        return redirect(url_for('settings'))
-
     try:
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute('SELECT * FROM surgeries ORDER BY code')
-        surgeries = cur.fetchall()
-        cur.close()
-        conn.close()
+        with db_cursor() as cur:
+            if cur is None:
+                flash('Database connection error', 'error')
+                return redirect(url_for('settings'))
+            cur.execute('SELECT * FROM surgeries ORDER BY code')
+            surgeries = cur.fetchall()
         return render_template('settings_surgeries.html', surgeries=surgeries)
     except Exception as e:
         flash(f'Error loading surgeries: {str(e)}', 'error')
-        if conn:
-            conn.close()
         return redirect(url_for('settings'))
 
 
@@ -3522,7 +4168,6 @@ def create_backup_sql():
             col_names = [desc[0] for desc in cur.description]
 
             # Write to CSV
-            import csv
             with open(csv_file, 'w', newline='', encoding='utf-8') as f:
                 writer = csv.writer(f)
                 writer.writerow(col_names)
@@ -3549,7 +4194,7 @@ def create_backup_sql():
         )
 
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
         return jsonify({
             'success': True,
@@ -3561,7 +4206,7 @@ def create_backup_sql():
 
     except Exception as e:
         if conn:
-            conn.close()
+            release_db_connection(conn)
         return jsonify({'error': f'Backup failed: {str(e)}'}), 500
 
 
@@ -3601,13 +4246,15 @@ def check_backup_tools():
                 'version': cur.fetchone()[0]
             }
             cur.close()
-            conn.close()
+            release_db_connection(conn)
         else:
             diagnostics['postgresql'] = {
                 'connected': False,
                 'error': 'Could not connect to database'
             }
     except Exception as e:
+        if conn:
+            release_db_connection(conn)
         diagnostics['postgresql'] = {
             'connected': False,
             'error': str(e)
@@ -3767,7 +4414,6 @@ def update_backup_config():
 @admin_required
 def download_backup(filename):
     """Download a backup file"""
-    from flask import send_file
     config = load_backup_config()
     backup_file = os.path.join(config['backup_dir'], filename)
 
@@ -3813,13 +4459,13 @@ def user_management():
         }
 
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
         return render_template('user_management.html', users=users, stats=stats)
     except Exception as e:
         flash(f'Error loading users: {str(e)}', 'error')
         if conn:
-            conn.close()
+            release_db_connection(conn)
         return render_template('user_management.html', users=[], stats={})
 
 
@@ -3838,23 +4484,20 @@ def create_user():
         password = request.form.get('password')
         role = request.form.get('role')
 
-        password_hash = bcrypt.generate_password_hash(password).decode('utf-8')
+        password_hash = hash_password(password)
 
         cur = conn.cursor()
-        cur.execute('''
-            INSERT INTO users (username, password_hash, email, role)
-            VALUES (%s, %s, %s, %s)
-        ''', (username, password_hash, email, role))
+        cur.execute(INSERT_USER_SQL, (username, password_hash, email, role))
         conn.commit()
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
         flash(f'User {username} created successfully!', 'success')
     except Exception as e:
         flash(f'Error creating user: {str(e)}', 'error')
         if conn:
             conn.rollback()
-            conn.close()
+            release_db_connection(conn)
 
     return redirect(url_for('user_management'))
 
@@ -3875,32 +4518,32 @@ def update_user():
         role = request.form.get('role')
         password = request.form.get('password')
 
-        cur = conn.cursor()
+        password_hash = hash_password(password) if password else None
 
-        if password:
-            password_hash = bcrypt.generate_password_hash(password).decode('utf-8')
-            cur.execute('''
-                UPDATE users
-                SET username = %s, email = %s, role = %s, password_hash = %s
-                WHERE user_id = %s
-            ''', (username, email, role, password_hash, user_id))
-        else:
-            cur.execute('''
-                UPDATE users
-                SET username = %s, email = %s, role = %s
-                WHERE user_id = %s
-            ''', (username, email, role, user_id))
+        cur = conn.cursor()
+        cur.execute('''
+            UPDATE users
+            SET username = %s, email = %s, role = %s,
+                password_hash = COALESCE(%s, password_hash)
+            WHERE user_id = %s
+            RETURNING user_id
+        ''', (username, email, role, password_hash, user_id))
+        updated = cur.fetchone()
 
         conn.commit()
         cur.close()
-        conn.close()
+        release_db_connection(conn)
+        user_cache.pop(int(user_id), None)
 
-        flash(f'User {username} updated successfully!', 'success')
+        if updated:
+            flash(f'User {username} updated successfully!', 'success')
+        else:
+            flash('User not found', 'error')
     except Exception as e:
         flash(f'Error updating user: {str(e)}', 'error')
         if conn:
             conn.rollback()
-            conn.close()
+            release_db_connection(conn)
 
     return redirect(url_for('user_management'))
 
@@ -3921,14 +4564,15 @@ def delete_user():
         cur.execute('DELETE FROM users WHERE user_id = %s', (user_id,))
         conn.commit()
         cur.close()
-        conn.close()
+        release_db_connection(conn)
+        user_cache.pop(int(user_id), None)
 
         flash('User deleted successfully!', 'success')
     except Exception as e:
         flash(f'Error deleting user: {str(e)}', 'error')
         if conn:
             conn.rollback()
-            conn.close()
+            release_db_connection(conn)
 
     return redirect(url_for('user_management'))
 
@@ -3944,21 +4588,20 @@ def reset_user_password():
 
     try:
         user_id = request.form.get('user_id')
-        default_password = 'password123'
-        password_hash = bcrypt.generate_password_hash(default_password).decode('utf-8')
+        password_hash = default_password_hash()
 
         cur = conn.cursor()
         cur.execute('UPDATE users SET password_hash = %s WHERE user_id = %s', (password_hash, user_id))
         conn.commit()
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
-        flash(f'Password reset to: {default_password}', 'success')
+        flash(f'Password reset to: {DEFAULT_PASSWORD}', 'success')
     except Exception as e:
         flash(f'Error resetting password: {str(e)}', 'error')
         if conn:
             conn.rollback()
-            conn.close()
+            release_db_connection(conn)
 
     return redirect(url_for('user_management'))
 
@@ -3977,11 +4620,17 @@ def api_icd10_ocular():
         cur = conn.cursor(cursor_factory=RealDictCursor)
 
         if request.method == 'GET':
-            cur.execute('SELECT * FROM icd10_ocular_conditions ORDER BY code')
-            codes = cur.fetchall()
+            # Single read - skip the implicit BEGIN/ROLLBACK
+            conn.autocommit = True
+            # Postgres builds the JSON array; ::text keeps psycopg2 from parsing it back
+            cur.execute('''
+                SELECT COALESCE(json_agg(t), '[]'::json)::text AS body
+                FROM (SELECT * FROM icd10_ocular_conditions ORDER BY code) t
+            ''')
+            body = cur.fetchone()['body']
             cur.close()
-            conn.close()
-            return jsonify(codes)
+            release_db_connection(conn)
+            return conditional_json_response(body)
 
         elif request.method == 'POST':
             data = request.get_json()
@@ -3993,7 +4642,7 @@ def api_icd10_ocular():
             new_code = cur.fetchone()
             conn.commit()
             cur.close()
-            conn.close()
+            release_db_connection(conn)
             return jsonify(new_code), 201
 
         elif request.method == 'PUT':
@@ -4007,7 +4656,7 @@ def api_icd10_ocular():
             updated_code = cur.fetchone()
             conn.commit()
             cur.close()
-            conn.close()
+            release_db_connection(conn)
             return jsonify(updated_code)
 
         elif request.method == 'DELETE':
@@ -4027,13 +4676,13 @@ def api_icd10_ocular():
 
             conn.commit()
             cur.close()
-            conn.close()
+            release_db_connection(conn)
             return jsonify({'success': True})
 
     except Exception as e:
         if conn:
             conn.rollback()
-            conn.close()
+            release_db_connection(conn)
         return jsonify({'error': str(e)}), 500
 
 
@@ -4049,11 +4698,17 @@ def api_icd10_systemic():
         cur = conn.cursor(cursor_factory=RealDictCursor)
 
         if request.method == 'GET':
-            cur.execute('SELECT * FROM icd10_systemic_conditions ORDER BY code')
-            codes = cur.fetchall()
+            # Single read - skip the implicit BEGIN/ROLLBACK
+            conn.autocommit = True
+            # Postgres builds the JSON array; ::text keeps psycopg2 from parsing it back
+            cur.execute('''
+                SELECT COALESCE(json_agg(t), '[]'::json)::text AS body
+                FROM (SELECT * FROM icd10_systemic_conditions ORDER BY code) t
+            ''')
+            body = cur.fetchone()['body']
             cur.close()
-            conn.close()
-            return jsonify(codes)
+            release_db_connection(conn)
+            return conditional_json_response(body)
 
         elif request.method == 'POST':
             data = request.get_json()
@@ -4065,7 +4720,7 @@ def api_icd10_systemic():
             new_code = cur.fetchone()
             conn.commit()
             cur.close()
-            conn.close()
+            release_db_connection(conn)
             return jsonify(new_code), 201
 
         elif request.method == 'PUT':
@@ -4079,7 +4734,7 @@ def api_icd10_systemic():
             updated_code = cur.fetchone()
             conn.commit()
             cur.close()
-            conn.close()
+            release_db_connection(conn)
             return jsonify(updated_code)
 
         elif request.method == 'DELETE':
@@ -4099,13 +4754,13 @@ def api_icd10_systemic():
 
             conn.commit()
             cur.close()
-            conn.close()
+            release_db_connection(conn)
             return jsonify({'success': True})
 
     except Exception as e:
         if conn:
             conn.rollback()
-            conn.close()
+            release_db_connection(conn)
         return jsonify({'error': str(e)}), 500
 
 
@@ -4121,6 +4776,129 @@ def icd10_bulk_upload(code_type):
     return render_template('icd10_bulk_upload.html', code_type=code_type)
 
 
+def read_upload_preview(file, filename, rows=10):
+    """
+    Read only the header and first rows of an uploaded CSV/Excel file
+
+    Returns: (preview DataFrame, total number of data rows)
+    """
+    if filename.endswith('.csv'):
+        # The raw stream: pandas ignores the encoding for a FileStorage wrapper
+        stream = getattr(file, 'stream', file)
+        try:
+            preview_df = pd.read_csv(stream, encoding='utf-8', nrows=rows)
+        except UnicodeDecodeError:
+            stream.seek(0)
+            preview_df = pd.read_csv(stream, encoding='latin-1', nrows=rows)
+
+        # Count records, not lines (a quoted cell may span several), streaming the
+        # file rather than holding it in memory. Quotes, commas and line breaks are
+        # the same bytes in UTF-8 and Latin-1, so decoding as Latin-1 never fails.
+        # Blank lines are skipped as pandas skips them; the header is excluded.
+        stream.seek(0)
+        text = io.TextIOWrapper(stream, encoding='latin-1', newline='')
+        try:
+            total_rows = max(sum(1 for record in csv.reader(text) if record) - 1, 0)
+        finally:
+            # Leave the upload open for stash_upload()
+            text.detach()
+        return preview_df, total_rows
+
+    # pandas stops reading the sheet after nrows
+    preview_df = pd.read_excel(file, nrows=rows, engine='calamine')
+
+    total_rows = None
+    if filename.endswith('.xlsx'):
+        file.seek(0)
+        workbook = load_workbook(file, read_only=True, data_only=True)
+        total_rows = workbook.active.max_row
+        workbook.close()
+    # max_row comes from the sheet's <dimension> tag, which some writers leave out
+    # or get wrong; count for real if it can't account for the rows just read
+    if total_rows is None or total_rows - 1 < len(preview_df):
+        file.seek(0)
+        return preview_df, len(pd.read_excel(file, usecols=[0], engine='calamine'))
+    return preview_df, max(total_rows - 1, 0)
+
+
+# Uploaded files are kept between preview and import so the browser sends them only once
+UPLOAD_STASH_DIR = os.path.join(tempfile.gettempdir(), 'raman_uploads')
+UPLOAD_STASH_TTL = 3600  # seconds
+UPLOAD_TOKEN_RE = re.compile(r'[0-9a-f]{32}')
+
+
+def stash_upload(file, filename):
+    """
+    Save an uploaded file for the follow-up import request
+
+    Returns: token identifying the stored file
+    """
+    os.makedirs(UPLOAD_STASH_DIR, exist_ok=True)
+
+    # Drop stashed files nobody imported
+    cutoff = time.time() - UPLOAD_STASH_TTL
+    for entry in os.scandir(UPLOAD_STASH_DIR):
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except OSError:
+            pass
+
+    token = secrets.token_hex(16)
+    file.seek(0)
+    file.save(os.path.join(UPLOAD_STASH_DIR, token + os.path.splitext(filename)[1]))
+    return token
+
+
+def find_stashed_upload(token):
+    """Path of a stashed upload, or None if the token is unknown or expired"""
+    if not token or not UPLOAD_TOKEN_RE.fullmatch(token):
+        return None
+    for ext in ('.csv', '.xls', '.xlsx'):
+        path = os.path.join(UPLOAD_STASH_DIR, token + ext)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def discard_stashed_upload(path):
+    """Remove a stashed upload once it has been imported"""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def read_upload_dataframe(source, filename, columns=None):
+    """
+    Parse a whole uploaded CSV/Excel file (file object or path) into a DataFrame
+
+    Only the mapped columns are read (matched ignoring surrounding whitespace)
+    and every cell is kept as text, so pandas skips type inference.
+    """
+    options = {'dtype': str}
+    if columns:
+        wanted = {column.strip() for column in columns if column}
+        options['usecols'] = lambda column: str(column).strip() in wanted
+
+    if filename.endswith('.csv'):
+        # Try different encodings
+        try:
+            return pd.read_csv(source, encoding='utf-8', **options)
+        except UnicodeDecodeError:
+            if hasattr(source, 'seek'):
+                source.seek(0)
+            return pd.read_csv(source, encoding='latin-1', **options)
+    # calamine parses workbooks natively instead of through openpyxl's Python XML handling
+    return pd.read_excel(source, engine='calamine', **options)
+
+
+# Column auto-detection patterns for ICD-10 bulk uploads
+ICD10_CODE_COLUMN_RE = re.compile(r'code|icd|id|codigo')
+ICD10_DESCRIPTION_COLUMN_RE = re.compile(r'description|desc|name|text|descripcion|nombre')
+ICD10_CATEGORY_COLUMN_RE = re.compile(r'category|cat|type|group|categoria|tipo')
+
+
 @app.route('/api/icd10-bulk-preview', methods=['POST'])
 @admin_required
 def icd10_bulk_preview():
@@ -4138,21 +4916,11 @@ def icd10_bulk_preview():
         return jsonify({'error': 'Invalid file format. Please upload CSV, XLS, or XLSX'}), 400
 
     try:
-        import pandas as pd
-
-        # Read file based on extension
-        if filename.endswith('.csv'):
-            # Try different encodings
-            try:
-                df = pd.read_csv(file, encoding='utf-8')
-            except UnicodeDecodeError:
-                file.seek(0)
-                df = pd.read_csv(file, encoding='latin-1')
-        else:
-            df = pd.read_excel(file)
+        # Only the first rows are parsed; the full file is read on import
+        df, total_rows = read_upload_preview(file, filename)
 
         # Get first 10 rows as preview
-        preview_data = df.head(10).fillna('').to_dict('records')
+        preview_data = df.fillna('').to_dict('records')
 
         # Get column names
         columns = df.columns.tolist()
@@ -4167,15 +4935,15 @@ def icd10_bulk_preview():
         for col in columns:
             col_lower = col.lower()
             # Auto-detect code column
-            if any(term in col_lower for term in ['code', 'icd', 'id', 'codigo']):
+            if ICD10_CODE_COLUMN_RE.search(col_lower):
                 if not auto_mapping['code_column']:
                     auto_mapping['code_column'] = col
             # Auto-detect description column
-            elif any(term in col_lower for term in ['description', 'desc', 'name', 'text', 'descripcion', 'nombre']):
+            elif ICD10_DESCRIPTION_COLUMN_RE.search(col_lower):
                 if not auto_mapping['description_column']:
                     auto_mapping['description_column'] = col
             # Auto-detect category column
-            elif any(term in col_lower for term in ['category', 'cat', 'type', 'group', 'categoria', 'tipo']):
+            elif ICD10_CATEGORY_COLUMN_RE.search(col_lower):
                 if not auto_mapping['category_column']:
                     auto_mapping['category_column'] = col
 
@@ -4183,8 +4951,9 @@ def icd10_bulk_preview():
             'success': True,
             'columns': columns,
             'preview': preview_data,
-            'total_rows': len(df),
-            'auto_mapping': auto_mapping
+            'total_rows': total_rows,
+            'auto_mapping': auto_mapping,
+            'upload_token': stash_upload(file, filename)
         })
 
     except Exception as e:
@@ -4195,10 +4964,16 @@ def icd10_bulk_preview():
 @admin_required
 def icd10_bulk_import():
     """Import ICD-10 codes from CSV/Excel with field mapping"""
-    if 'file' not in request.files:
-        return jsonify({'error': 'No file provided'}), 400
+    # Prefer the copy stashed during preview over a second upload
+    file = find_stashed_upload(request.form.get('upload_token'))
+    if file:
+        filename = file
+    elif 'file' in request.files:
+        file = request.files['file']
+        filename = file.filename.lower()
+    else:
+        return jsonify({'error': 'No file provided (or the uploaded file expired, please select it again)'}), 400
 
-    file = request.files['file']
     code_type = request.form.get('code_type')  # 'ocular' or 'systemic'
     code_column = request.form.get('code_column')
     description_column = request.form.get('description_column')
@@ -4217,38 +4992,37 @@ def icd10_bulk_import():
         return jsonify({'error': 'Database connection error'}), 500
 
     try:
-        import pandas as pd
-
         # Read file
-        filename = file.filename.lower()
-        if filename.endswith('.csv'):
-            try:
-                df = pd.read_csv(file, encoding='utf-8')
-            except UnicodeDecodeError:
-                file.seek(0)
-                df = pd.read_csv(file, encoding='latin-1')
-        else:
-            df = pd.read_excel(file)
+        df = read_upload_dataframe(file, filename, [code_column, description_column, category_column])
 
         cur = conn.cursor()
+        # Re-runnable bulk load: don't wait for the WAL flush on commit. A crash can only
+        # lose the whole import (the transaction is atomic), never leave it half applied.
+        cur.execute('SET LOCAL synchronous_commit = OFF')
 
-        imported = 0
+        rows = []
         skipped = 0
         errors = []
 
-        for index, row in df.iterrows():
-            try:
-                code = str(row[code_column]).strip() if pd.notna(row[code_column]) else None
-                description = str(row[description_column]).strip() if pd.notna(row[description_column]) else None
+        # Clean the mapped columns in one pandas pass each, then loop over plain arrays
+        def cleaned_column(column):
+            return df[column].fillna('').astype(str).str.strip().to_numpy()
 
+        codes = cleaned_column(code_column)
+        descriptions = cleaned_column(description_column)
+        if category_column and category_column in df.columns:
+            categories = cleaned_column(category_column)
+        else:
+            categories = np.full(len(df), '', dtype=object)
+
+        for index, (code, description, category) in enumerate(zip(codes, descriptions, categories)):
+            try:
                 if not code or not description:
                     skipped += 1
                     continue
 
-                # Get category if column is mapped
-                category = None
-                if category_column and category_column in row:
-                    category = str(row[category_column]).strip() if pd.notna(row[category_column]) else None
+                # Category from the mapped column, if any
+                category = category or None
 
                 # Auto-detect category for ocular codes if not provided
                 if code_type == 'ocular' and not category:
@@ -4297,26 +5071,47 @@ def icd10_bulk_import():
                     elif first_char == 'Z':
                         category = 'Health factors'
 
-                # Insert or update
-                cur.execute(f'''
-                    INSERT INTO {table_name} (code, description, category, active)
-                    VALUES (%s, %s, %s, TRUE)
-                    ON CONFLICT (code) DO UPDATE
-                    SET description = EXCLUDED.description,
-                        category = EXCLUDED.category,
-                        active = TRUE,
-                        updated_at = CURRENT_TIMESTAMP
-                ''', (code, description, category))
-
-                imported += 1
+                rows.append((index, code, description, category))
 
             except Exception as e:
                 errors.append(f"Row {index + 2}: {str(e)}")
                 skipped += 1
 
+        # Stream the rows into a staging table with COPY
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        buffer.seek(0)
+
+        cur.execute('''
+            CREATE TEMP TABLE icd10_import_stage (
+                row_num INTEGER,
+                code TEXT,
+                description TEXT,
+                category TEXT
+            ) ON COMMIT DROP
+        ''')
+        cur.copy_expert('COPY icd10_import_stage FROM STDIN WITH (FORMAT csv)', buffer)
+
+        # Insert or update in one statement; a code repeated in the file keeps its last row
+        cur.execute(f'''
+            INSERT INTO {table_name} (code, description, category, active)
+            SELECT DISTINCT ON (code) code, description, category, TRUE
+            FROM icd10_import_stage
+            ORDER BY code, row_num DESC
+            ON CONFLICT (code) DO UPDATE
+            SET description = EXCLUDED.description,
+                category = EXCLUDED.category,
+                active = TRUE,
+                updated_at = CURRENT_TIMESTAMP
+        ''')
+        imported = len(rows)
+
         conn.commit()
         cur.close()
-        conn.close()
+        release_db_connection(conn)
+        if isinstance(file, str):
+            # Imported from the stash (a path, not an upload)
+            discard_stashed_upload(file)
 
         return jsonify({
             'success': True,
@@ -4328,10 +5123,19 @@ def icd10_bulk_import():
     except Exception as e:
         if conn:
             conn.rollback()
-            conn.close()
+            release_db_connection(conn)
         return jsonify({'error': f'Import failed: {str(e)}'}), 500
 
 
+def excel_column_widths(df, max_width=50):
+    """Column widths (longest value or header + 2, capped) computed column-wise from a DataFrame"""
+    widths = []
+    for column in df.columns:
+        longest = df[column].astype(str).str.len().max() if not df.empty else 0
+        widths.append(min(max(int(longest), len(str(column))) + 2, max_width))
+    return widths
+
+
 @app.route('/api/icd10-export/<code_type>')
 @admin_required
 def icd10_export(code_type):
@@ -4344,9 +5148,6 @@ def icd10_export(code_type):
         return jsonify({'error': 'Database connection error'}), 500
 
     try:
-        import pandas as pd
-        from io import BytesIO
-
         table_name = f'icd10_{code_type}_conditions'
 
         # Get all codes
@@ -4359,42 +5160,37 @@ def icd10_export(code_type):
             ORDER BY code
         '''
 
-        df = pd.read_sql_query(query, conn)
-        conn.close()
+        cur = conn.cursor()
+        cur.execute(query)
+        df = pd.DataFrame(cur.fetchall(), columns=[desc[0] for desc in cur.description])
+        cur.close()
+        release_db_connection(conn)
 
-        # Create Excel file
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name=f'{code_type.title()} Codes', index=False)
-
-            # Auto-adjust column widths
-            worksheet = writer.sheets[f'{code_type.title()} Codes']
-            for column in worksheet.columns:
-                max_length = 0
-                column = [cell for cell in column]
-                for cell in column:
-                    try:
-                        if len(str(cell.value)) > max_length:
-                            max_length = len(str(cell.value))
-                    except:
-                        pass
-                adjusted_width = min(max_length + 2, 50)
-                worksheet.column_dimensions[column[0].column_letter].width = adjusted_width
+        # Create Excel file in an anonymous temp file (removed once the response is closed)
+        sheet_name = f'{code_type.title()} Codes'
+        output = tempfile.TemporaryFile(suffix='.xlsx')
+        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+            df.to_excel(writer, sheet_name=sheet_name, index=False)
+
+            # Column widths computed column-wise from the data, not cell by cell
+            worksheet = writer.sheets[sheet_name]
+            for col_idx, width in enumerate(excel_column_widths(df)):
+                worksheet.set_column(col_idx, col_idx, width)
 
         output.seek(0)
 
-        from flask import Response
-        return Response(
-            output.getvalue(),
+        # Streamed from the file descriptor (sendfile where the server supports it)
+        return send_file(
+            output,
             mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            headers={
-                'Content-Disposition': f'attachment; filename=icd10_{code_type}_codes_{datetime.now().strftime("%Y%m%d")}.xlsx'
-            }
+            as_attachment=True,
+            download_name=f'icd10_{code_type}_codes_{datetime.now().strftime("%Y%m%d")}.xlsx',
+            max_age=0
         )
 
     except Exception as e:
         if conn:
-            conn.close()
+            release_db_connection(conn)
         return jsonify({'error': f'Export failed: {str(e)}'}), 500
 
 
@@ -4410,11 +5206,17 @@ def api_medications():
         cur = conn.cursor(cursor_factory=RealDictCursor)
 
         if request.method == 'GET':
-            cur.execute('SELECT * FROM medications ORDER BY trade_name')
-            medications = cur.fetchall()
+            # Single read - skip the implicit BEGIN/ROLLBACK
+            conn.autocommit = True
+            # Postgres builds the JSON array; ::text keeps psycopg2 from parsing it back
+            cur.execute('''
+                SELECT COALESCE(json_agg(t), '[]'::json)::text AS body
+                FROM (SELECT * FROM medications ORDER BY trade_name) t
+            ''')
+            body = cur.fetchone()['body']
             cur.close()
-            conn.close()
-            return jsonify(medications)
+            release_db_connection(conn)
+            return conditional_json_response(body)
 
         elif request.method == 'POST':
             data = request.get_json()
@@ -4428,7 +5230,7 @@ def api_medications():
             new_medication = cur.fetchone()
             conn.commit()
             cur.close()
-            conn.close()
+            release_db_connection(conn)
             return jsonify(new_medication), 201
 
         elif request.method == 'PUT':
@@ -4444,7 +5246,7 @@ def api_medications():
             updated_medication = cur.fetchone()
             conn.commit()
             cur.close()
-            conn.close()
+            release_db_connection(conn)
             return jsonify(updated_medication)
 
         elif request.method == 'DELETE':
@@ -4456,13 +5258,13 @@ def api_medications():
             ''', (data['id'],))
             conn.commit()
             cur.close()
-            conn.close()
+            release_db_connection(conn)
             return jsonify({'success': True})
 
     except Exception as e:
         if conn:
             conn.rollback()
-            conn.close()
+            release_db_connection(conn)
         return jsonify({'error': str(e)}), 500
 
 
@@ -4478,11 +5280,17 @@ def api_surgeries():
         cur = conn.cursor(cursor_factory=RealDictCursor)
 
         if request.method == 'GET':
-            cur.execute('SELECT * FROM surgeries ORDER BY code')
-            surgeries = cur.fetchall()
+            # Single read - skip the implicit BEGIN/ROLLBACK
+            conn.autocommit = True
+            # Postgres builds the JSON array; ::text keeps psycopg2 from parsing it back
+            cur.execute('''
+                SELECT COALESCE(json_agg(t), '[]'::json)::text AS body
+                FROM (SELECT * FROM surgeries ORDER BY code) t
+            ''')
+            body = cur.fetchone()['body']
             cur.close()
-            conn.close()
-            return jsonify(surgeries)
+            release_db_connection(conn)
+            return conditional_json_response(body)
 
         elif request.method == 'POST':
             data = request.get_json()
@@ -4490,7 +5298,7 @@ def api_surgeries():
 
             if not surgery_code:
                 cur.close()
-                conn.close()
+                release_db_connection(conn)
                 return jsonify({'error': 'Surgery code is required'}), 400
 
             cur.execute('''
@@ -4501,7 +5309,7 @@ def api_surgeries():
             new_surgery = cur.fetchone()
             conn.commit()
             cur.close()
-            conn.close()
+            release_db_connection(conn)
             return jsonify(new_surgery), 201
 
         elif request.method == 'PUT':
@@ -4515,7 +5323,7 @@ def api_surgeries():
             updated_surgery = cur.fetchone()
             conn.commit()
             cur.close()
-            conn.close()
+            release_db_connection(conn)
             return jsonify(updated_surgery)
 
         elif request.method == 'DELETE':
@@ -4527,36 +5335,30 @@ def api_surgeries():
             ''', (data['id'],))
             conn.commit()
             cur.close()
-            conn.close()
+            release_db_connection(conn)
             return jsonify({'success': True})
 
     except Exception as e:
         if conn:
             conn.rollback()
-            conn.close()
+            release_db_connection(conn)
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/check_patient_id/<int:patient_id>')
+@app.route('/api/check_patient_id/<int:patient_id>', methods=['GET', 'HEAD'])
 @login_required
 def check_patient_id(patient_id):
-    """Check if a patient ID is available"""
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({'error': 'Database connection error', 'available': False}), 500
-
+    """Check if a patient ID is available (HEAD: 204 if free, 409 if taken)"""
     try:
-        cur = conn.cursor()
-        # Check if the patient_id exists in the sensitive table
-        cur.execute("SELECT patient_id FROM patients_sensitive WHERE patient_id = %s", (patient_id,))
-        exists = cur.fetchone() is not None
-        cur.close()
-        conn.close()
-        return jsonify({'available': not exists, 'patient_id': patient_id})
+        exists = patient_id_taken(patient_id)
     except Exception as e:
-        if conn:
-            conn.close()
         return jsonify({'error': str(e), 'available': False}), 500
+    if exists is None:
+        return jsonify({'error': 'Database connection error', 'available': False}), 500
+
+    if request.method == 'HEAD':
+        return patient_id_check_response('', 409 if exists else 204)
+    return patient_id_check_response(jsonify({'available': not exists, 'patient_id': patient_id}))
 
 
 @app.route('/api/next_available_patient_id')
@@ -4568,21 +5370,21 @@ def api_next_available_patient_id():
         return jsonify({'error': 'Database connection error', 'next_id': STARTING_PATIENT_ID}), 500
 
     try:
+        conn.autocommit = True
         cur = conn.cursor()
-        # Get the maximum patient_id from the database
-        cur.execute("SELECT MAX(patient_id) FROM patients_sensitive")
-        result = cur.fetchone()
-        max_id = result[0] if result[0] is not None else (STARTING_PATIENT_ID - 1)
-
-        # Next ID is max + 1, but ensure it's at least STARTING_PATIENT_ID
-        next_id = max(max_id + 1, STARTING_PATIENT_ID)
+        # Next ID is max + 1, but at least STARTING_PATIENT_ID (MAX is served by the primary key index)
+        cur.execute(
+            "SELECT GREATEST(COALESCE(MAX(patient_id), 0) + 1, %s) FROM patients_sensitive",
+            (STARTING_PATIENT_ID,)
+        )
+        next_id = cur.fetchone()[0]
 
         cur.close()
-        conn.close()
+        release_db_connection(conn)
         return jsonify({'next_id': next_id})
     except Exception as e:
         if conn:
-            conn.close()
+            release_db_connection(conn)
         return jsonify({'error': str(e), 'next_id': STARTING_PATIENT_ID}), 500
 
 
@@ -4593,7 +5395,7 @@ def health_check():
         # Test database connection
         conn = get_db_connection()
         if conn:
-            conn.close()
+            release_db_connection(conn)
             return {'status': 'healthy'}, 200
         return {'status': 'unhealthy'}, 503
     except Exception as e:
@@ -4607,6 +5409,16 @@ def medications_bulk_upload():
     return render_template('medications_bulk_upload.html')
 
 
+# Column auto-detection patterns for medication bulk uploads
+MEDICATION_TRADE_COLUMN_RE = re.compile(r'trade|brand|product')
+MEDICATION_GENERIC_COLUMN_RE = re.compile(r'generic|substance|active|ingredient')
+MEDICATION_TYPE_COLUMN_RE = re.compile(r'type|category|class')
+
+# Medication type keywords for bulk imports (anything else maps to 'Both')
+MEDICATION_OCULAR_TYPE_PATTERN = r'ocular|eye|ophthalm'
+MEDICATION_SYSTEMIC_TYPE_PATTERN = r'systemic|oral|general'
+
+
 @app.route('/api/medications-bulk-preview', methods=['POST'])
 @admin_required
 def medications_bulk_preview():
@@ -4624,23 +5436,14 @@ def medications_bulk_preview():
         return jsonify({'error': 'Invalid file format. Please upload CSV, XLS, or XLSX'}), 400
 
     try:
-        import pandas as pd
-
-        # Read file based on extension
-        if filename.endswith('.csv'):
-            try:
-                df = pd.read_csv(file, encoding='utf-8')
-            except UnicodeDecodeError:
-                file.seek(0)
-                df = pd.read_csv(file, encoding='latin-1')
-        else:
-            df = pd.read_excel(file)
+        # Only the first rows are parsed; the full file is read on import
+        df, total_rows = read_upload_preview(file, filename)
 
         # Clean column names
         df.columns = df.columns.str.strip()
 
         # Get first 10 rows as preview
-        preview_data = df.head(10).fillna('').to_dict('records')
+        preview_data = df.fillna('').to_dict('records')
 
         # Get column names
         columns = df.columns.tolist()
@@ -4655,15 +5458,15 @@ def medications_bulk_preview():
         for col in columns:
             col_lower = col.lower()
             # Auto-detect trade name column
-            if any(term in col_lower for term in ['trade', 'brand', 'product']):
+            if MEDICATION_TRADE_COLUMN_RE.search(col_lower):
                 if not auto_mapping['trade_column']:
                     auto_mapping['trade_column'] = col
             # Auto-detect generic name column
-            elif any(term in col_lower for term in ['generic', 'substance', 'active', 'ingredient']):
+            elif MEDICATION_GENERIC_COLUMN_RE.search(col_lower):
                 if not auto_mapping['generic_column']:
                     auto_mapping['generic_column'] = col
             # Auto-detect type column
-            elif any(term in col_lower for term in ['type', 'category', 'class']):
+            elif MEDICATION_TYPE_COLUMN_RE.search(col_lower):
                 if not auto_mapping['type_column']:
                     auto_mapping['type_column'] = col
 
@@ -4671,8 +5474,9 @@ def medications_bulk_preview():
             'success': True,
             'columns': columns,
             'preview': preview_data,
-            'total_rows': len(df),
-            'auto_mapping': auto_mapping
+            'total_rows': total_rows,
+            'auto_mapping': auto_mapping,
+            'upload_token': stash_upload(file, filename)
         })
 
     except Exception as e:
@@ -4683,10 +5487,16 @@ def medications_bulk_preview():
 @admin_required
 def medications_bulk_import():
     """Import medications from CSV/Excel with field mapping"""
-    if 'file' not in request.files:
-        return jsonify({'error': 'No file provided'}), 400
+    # Prefer the copy stashed during preview over a second upload
+    file = find_stashed_upload(request.form.get('upload_token'))
+    if file:
+        filename = file
+    elif 'file' in request.files:
+        file = request.files['file']
+        filename = file.filename.lower()
+    else:
+        return jsonify({'error': 'No file provided (or the uploaded file expired, please select it again)'}), 400
 
-    file = request.files['file']
     trade_column = request.form.get('trade_column')
     generic_column = request.form.get('generic_column')
     type_column = request.form.get('type_column')  # Optional
@@ -4699,81 +5509,86 @@ def medications_bulk_import():
         return jsonify({'error': 'Database connection error'}), 500
 
     try:
-        import pandas as pd
-
         # Read file
-        filename = file.filename.lower()
-        if filename.endswith('.csv'):
-            try:
-                df = pd.read_csv(file, encoding='utf-8')
-            except UnicodeDecodeError:
-                file.seek(0)
-                df = pd.read_csv(file, encoding='latin-1')
-        else:
-            df = pd.read_excel(file)
+        df = read_upload_dataframe(file, filename, [trade_column, generic_column, type_column])
 
         # Clean column names
         df.columns = df.columns.str.strip()
 
         cur = conn.cursor()
-
-        imported = 0
-        skipped = 0
+        # Re-runnable bulk load: don't wait for the WAL flush on commit. A crash can only
+        # lose the whole import (the transaction is atomic), never leave it half applied.
+        cur.execute('SET LOCAL synchronous_commit = OFF')
+
+        # Clean and classify whole columns at once rather than row by row
+        trade_names = df[trade_column].astype(str).str.strip().where(df[trade_column].notna(), '')
+        generic_names = df[generic_column].astype(str).str.strip().where(df[generic_column].notna(), '')
+        # Multiple generic names are kept as-is with semicolons ("dexamethasone; neomycin; polymyxin B")
+
+        # Map the optional type column to our types (default 'Both')
+        if type_column and type_column in df.columns:
+            type_values = df[type_column].astype(str).str.lower().where(df[type_column].notna(), '')
+            medication_types = np.select(
+                [type_values.str.contains(MEDICATION_OCULAR_TYPE_PATTERN),
+                 type_values.str.contains(MEDICATION_SYSTEMIC_TYPE_PATTERN)],
+                ['Ocular', 'Systemic'],
+                default='Both'
+            )
+        else:
+            medication_types = np.full(len(df), 'Both')
+
+        valid = (trade_names != '') & (generic_names != '')
+        stage = pd.DataFrame({
+            'trade_name': trade_names,
+            'generic_name': generic_names,
+            'medication_type': medication_types
+        }, index=df.index)[valid]
+        skipped = int((~valid).sum())
         errors = []
 
-        for index, row in df.iterrows():
-            try:
-                trade_name = str(row[trade_column]).strip() if pd.notna(row[trade_column]) else None
-                generic_name = str(row[generic_column]).strip() if pd.notna(row[generic_column]) else None
-
-                if not trade_name or not generic_name:
-                    skipped += 1
-                    continue
-
-                # Handle multiple generic names (keep them as-is with semicolons)
-                # This preserves the format: "dexamethasone; neomycin; polymyxin B"
-
-                # Get medication type if column is mapped
-                medication_type = 'Both'  # Default
-                if type_column and type_column in row:
-                    type_value = str(row[type_column]).strip() if pd.notna(row[type_column]) else None
-                    if type_value:
-                        # Try to map to our types
-                        type_lower = type_value.lower()
-                        if 'ocular' in type_lower or 'eye' in type_lower or 'ophthalm' in type_lower:
-                            medication_type = 'Ocular'
-                        elif 'systemic' in type_lower or 'oral' in type_lower or 'general' in type_lower:
-                            medication_type = 'Systemic'
-                        else:
-                            medication_type = 'Both'
-
-                # Check if medication already exists (by trade name)
-                cur.execute('SELECT id FROM medications WHERE trade_name = %s', (trade_name,))
-                existing = cur.fetchone()
-
-                if existing:
-                    # Update existing medication
-                    cur.execute('''
-                        UPDATE medications 
-                        SET generic_name = %s, medication_type = %s, active = TRUE, updated_at = CURRENT_TIMESTAMP
-                        WHERE trade_name = %s
-                    ''', (generic_name, medication_type, trade_name))
-                else:
-                    # Insert new medication
-                    cur.execute('''
-                        INSERT INTO medications (trade_name, generic_name, medication_type, active)
-                        VALUES (%s, %s, %s, TRUE)
-                    ''', (trade_name, generic_name, medication_type))
+        # Stream the rows into a staging table with COPY (the index becomes row_num)
+        buffer = io.StringIO()
+        stage.to_csv(buffer, header=False)
+        buffer.seek(0)
 
-                imported += 1
+        cur.execute('''
+            CREATE TEMP TABLE medications_import_stage (
+                row_num INTEGER,
+                trade_name TEXT,
+                generic_name TEXT,
+                medication_type TEXT
+            ) ON COMMIT DROP
+        ''')
+        cur.copy_expert('COPY medications_import_stage FROM STDIN WITH (FORMAT csv)', buffer)
 
-            except Exception as e:
-                errors.append(f"Row {index + 2}: {str(e)}")
-                skipped += 1
+        # Upsert by trade name in one statement: update the matches, insert the rest.
+        # A trade name repeated in the file keeps its last row.
+        cur.execute('''
+            WITH latest AS (
+                SELECT DISTINCT ON (trade_name) trade_name, generic_name, medication_type
+                FROM medications_import_stage
+                ORDER BY trade_name, row_num DESC
+            ), updated AS (
+                UPDATE medications m
+                SET generic_name = s.generic_name, medication_type = s.medication_type,
+                    active = TRUE, updated_at = CURRENT_TIMESTAMP
+                FROM latest s
+                WHERE m.trade_name = s.trade_name
+                RETURNING m.trade_name
+            )
+            INSERT INTO medications (trade_name, generic_name, medication_type, active)
+            SELECT s.trade_name, s.generic_name, s.medication_type, TRUE
+            FROM latest s
+            WHERE NOT EXISTS (SELECT 1 FROM updated u WHERE u.trade_name = s.trade_name)
+        ''')
+        imported = len(stage)
 
         conn.commit()
         cur.close()
-        conn.close()
+        release_db_connection(conn)
+        if isinstance(file, str):
+            # Imported from the stash (a path, not an upload)
+            discard_stashed_upload(file)
 
         return jsonify({
             'success': True,
@@ -4785,23 +5600,21 @@ def medications_bulk_import():
     except Exception as e:
         if conn:
             conn.rollback()
-            conn.close()
+            release_db_connection(conn)
         return jsonify({'error': f'Import failed: {str(e)}'}), 500
 
 
 @app.route('/api/medications-export')
 @admin_required
 def medications_export():
-    """Export medications to Excel"""
+    """Export medications to Excel (default) or CSV (?format=csv)"""
+    export_format = request.args.get('format', 'xlsx')
+
     conn = get_db_connection()
     if not conn:
         return jsonify({'error': 'Database connection error'}), 500
 
     try:
-        import pandas as pd
-        from io import BytesIO
-        from datetime import datetime
-
         # Get all medications
         query = '''
             SELECT 
@@ -4813,42 +5626,50 @@ def medications_export():
             ORDER BY trade_name
         '''
 
-        df = pd.read_sql_query(query, conn)
-        conn.close()
+        # COPY writes the CSV inside Postgres - no Python object per cell
+        csv_output = tempfile.TemporaryFile(suffix='.csv')
+        cur = conn.cursor()
+        cur.copy_expert(f'COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)', csv_output)
+        cur.close()
+        release_db_connection(conn)
+        csv_output.seek(0)
+
+        if export_format == 'csv':
+            return send_file(
+                csv_output,
+                mimetype='text/csv',
+                as_attachment=True,
+                download_name=f'medications_{datetime.now().strftime("%Y%m%d")}.csv',
+                max_age=0
+            )
+
+        # The same CSV feeds the workbook (kept as text so names like '007' survive)
+        df = pd.read_csv(csv_output, dtype=str, keep_default_na=False)
+        csv_output.close()
 
-        # Create Excel file
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        # Create Excel file with xlsxwriter (no per-cell style bookkeeping like openpyxl)
+        output = tempfile.TemporaryFile(suffix='.xlsx')
+        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
             df.to_excel(writer, sheet_name='Medications', index=False)
 
-            # Auto-adjust column widths
+            # Column widths computed column-wise from the data
             worksheet = writer.sheets['Medications']
-            for column in worksheet.columns:
-                max_length = 0
-                column = [cell for cell in column]
-                for cell in column:
-                    try:
-                        if len(str(cell.value)) > max_length:
-                            max_length = len(str(cell.value))
-                    except:
-                        pass
-                adjusted_width = min(max_length + 2, 50)
-                worksheet.column_dimensions[column[0].column_letter].width = adjusted_width
+            for col_idx, width in enumerate(excel_column_widths(df)):
+                worksheet.set_column(col_idx, col_idx, width)
 
         output.seek(0)
 
-        from flask import Response
-        return Response(
-            output.getvalue(),
+        return send_file(
+            output,
             mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            headers={
-                'Content-Disposition': f'attachment; filename=medications_{datetime.now().strftime("%Y%m%d")}.xlsx'
-            }
+            as_attachment=True,
+            download_name=f'medications_{datetime.now().strftime("%Y%m%d")}.xlsx',
+            max_age=0
         )
 
     except Exception as e:
         if conn:
-            conn.close()
+            release_db_connection(conn)
         return jsonify({'error': f'Export failed: {str(e)}'}), 500
 
 
@@ -4859,4 +5680,5 @@ if __name__ == '__main__':
     print("Starting Flask development server on http://0.0.0.0:5000")
     print("=" * 60 + "\n")
 
-    app.run(host='0.0.0.0', port=5000, debug=False)
+    # Debugger/reloader only on request; production runs under gunicorn (gunicorn_config.py)
+    app.run(host='0.0.0.0', port=5000, debug=os.getenv('FLASK_DEBUG', 'False').lower() in ('1', 'true'))
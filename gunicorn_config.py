@@ -11,7 +11,10 @@ backlog = 2048
 # Worker processes
 # Formula: (2 × CPU cores) + 1
 workers = multiprocessing.cpu_count() * 2 + 1
-worker_class = "sync"  # Options: sync, gevent, eventlet
+# Threaded workers let requests overlap while one is waiting on bcrypt or the
+# database (both release the GIL); each worker shares one connection pool
+worker_class = "gthread"  # Options: sync, gthread, gevent, eventlet
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
 worker_connections = 1000
 
 # Worker lifecycle